@@ -30,6 +30,22 @@ function copyPdfFilesSync(filePaths) {
 
 // for callback
 function addFilesToDB(filePaths) {
+  // Add as a job of the search server, progress is reported by the server
+  var body = JSON.stringify({ files: filePaths });
+  var req = require('http').request({
+    host: 'localhost', port: 8000, path: '/jobs', method: 'POST',
+    headers: { 'Content-Type': 'application/json',
+               'Content-Length': Buffer.byteLength(body) }
+  }, (res) => { res.resume(); });
+  req.on('error', (err) => {
+    console.log('Could not submit job: ' + err.message);
+    addFilesToDBProcess(filePaths);
+  });
+  req.end(body);
+}
+
+// Add by a separate process, progress is written to file
+function addFilesToDBProcess(filePaths) {
   fs.writeFileSync('./addfiles', filePaths);
   if (process.platform == 'win32') {
     //var sub = require('child_process').spawn('./mirusan_search.exe', ['--add-files'].concat(filePaths));
@@ -50,6 +50,7 @@ search query numResultPage sortField reverse =
         "http://localhost:8000/search?q=" ++ query ++ "&sort_field=" ++ sortField
           ++ "&reverse=" ++ (toString reverse)
           ++ "&result-page=" ++ (toString numResultPage)
+          ++ "&fields=title,file_path,parent_file_path,page&highlight=1"
   in
       Http.send NewSearchResult (Http.get url searchResponseDecoder)
 
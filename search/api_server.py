@@ -2,10 +2,14 @@
 from config import Config
 from helper import normalize
 from index_manager import IndexManager
+from job_manager import JobManager
+from metrics import metrics
 from search_manager import Search
+from writer_service import Compactor, WriterService
 
 import falcon
 
+from concurrent.futures import ThreadPoolExecutor
 from wsgiref import simple_server
 import json
 import os
@@ -13,6 +17,37 @@ import threading
 import time
 
 
+def dump_json(obj, compact=False):
+    with metrics.timer('serialize'):
+        if compact:
+            return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+        return json.dumps(obj, indent=4, ensure_ascii=False)
+
+
+def load_json(req):
+    return json.loads(req.stream.read(req.content_length or 0)
+                      .decode('utf-8'))
+
+
+class TimingMiddleware:
+    """Record time, count and errors of requests by resource. Resources
+    catch their exceptions, and mark errors in req.context.
+    """
+    def process_request(self, req, resp):
+        req.context['start_time'] = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded=True):
+        if 'start_time' not in req.context:
+            return
+        name = type(resource).__name__ if resource is not None else 'None'
+        metrics.observe('request',
+                        time.perf_counter() - req.context['start_time'],
+                        resource=name)
+        metrics.count('requests', resource=name)
+        if not req_succeeded or 'error' in req.context:
+            metrics.count('request_errors', resource=name)
+
+
 class ConfigResource:
     def on_get(self, req, resp):
         try:
@@ -20,6 +55,7 @@ class ConfigResource:
             resp.body = json.dumps(config, indent=4, ensure_ascii=False)
         except Exception as err:
             Config.logger.exception('Error in get config: %s', err)
+            req.context['error'] = True
             print(err)
             res = {'message': str(err)}
             resp.body = json.dumps(res, indent=4, ensure_ascii=False)
@@ -32,7 +68,8 @@ class DataBaseResource:
 
 
 class SearchDB:
-    search = Search()
+    def __init__(self, search):
+        self.search = search
 
     def on_get(self, req, resp):
         try:
@@ -66,32 +103,112 @@ class SearchDB:
             else:
                 pagelen = int(pl)
 
+            # e.g. fields=title,page,file_path,highlighted_body
+            fs = req.get_param_as_list('fields')
+            if fs is None:
+                fields = None  # all fields
+            else:
+                # comma-separated values are not split by newer falcon
+                fields = [f for v in fs for f in v.split(',')]
+
+            cl = req.get_param('content-length')
+            if cl is None:
+                content_length = None  # whole page text
+            else:
+                content_length = int(cl)
+
+            # rows of documents with up to group-pages pages each
+            gp = req.get_param('group-pages')
+            if gp is None:
+                group_pages = None  # rows of pages
+            else:
+                group_pages = int(gp)
+                if group_pages < 1:
+                    raise ValueError('group-pages must be 1 or more: ' + gp)
+
+            highlight = req.get_param('highlight') == '1'
+            fragments = req.get_param_as_int('fragments')
+            fragment_size = req.get_param_as_int('fragment-size')
+
+            compact = req.get_param('compact') == '1'
+
             search_result = self.search.search(query_str=qstr,
                                                sort_field=sort_field,
                                                reverse=reverse,
                                                n_page=n_result_page,
-                                               pagelen=pagelen)
-
-            resp.body = json.dumps(search_result, indent=4, ensure_ascii=False)
+                                               pagelen=pagelen,
+                                               fields=fields,
+                                               content_length=content_length,
+                                               group_pages=group_pages,
+                                               highlight=highlight,
+                                               max_fragments=fragments,
+                                               fragment_size=fragment_size)
+
+            resp.body = dump_json(search_result, compact)
         except Exception as err:
             Config.logger.exception('Error in search: %s', err)
+            req.context['error'] = True
+            print(err)
+            res = {'message': str(err)}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        return
+
+
+class Highlight:
+    """Highlighted fragments of given pages, e.g. of visible rows only:
+    GET /highlight?q=QUERY&file-path=PATH&file-path=PATH, or POST
+    {"q": QUERY, "file_paths": [...]}. Optional fragments and
+    fragment-size limit the number and size of fragments per page.
+    """
+    def __init__(self, search):
+        self.search = search
+
+    def _highlight(self, req, resp, qstr, file_paths, fragments,
+                   fragment_size):
+        try:
+            if not qstr:
+                raise ValueError('No query')
+            res = self.search.highlight(normalize(qstr), file_paths or [],
+                                        max_fragments=fragments,
+                                        fragment_size=fragment_size)
+            resp.body = dump_json(res, req.get_param('compact') == '1')
+        except Exception as err:
+            Config.logger.exception('Error in highlight: %s', err)
+            req.context['error'] = True
             print(err)
             res = {'message': str(err)}
             resp.body = json.dumps(res, indent=4, ensure_ascii=False)
         return
 
+    def on_get(self, req, resp):
+        self._highlight(req, resp, req.get_param('q'),
+                        req.get_param_as_list('file-path'),
+                        req.get_param_as_int('fragments'),
+                        req.get_param_as_int('fragment-size'))
+
+    def on_post(self, req, resp):
+        try:
+            body = load_json(req)
+        except ValueError:
+            body = {}
+        self._highlight(req, resp, body.get('q'), body.get('file_paths'),
+                        body.get('fragments'), body.get('fragment_size'))
+
 
 class DeleteDocument:
+    def __init__(self, writer):
+        self.writer = writer
+
     def on_get(self, req, resp):
         try:
-            im = IndexManager()
             gid = req.get_param('gid')
-            message = im.delete_document(gid)
-            im.writer.commit()
+            message = self.writer.submit(IndexManager.delete_document,
+                                         gid).result()
             res = {'message': message}
             resp.body = json.dumps(res, indent=4, ensure_ascii=False)
         except Exception as err:
             Config.logger.exception('Error in delete db: %s', err)
+            req.context['error'] = True
             print(err)
             res = {'message': str(err)}
             resp.body = json.dumps(res, indent=4, ensure_ascii=False)
@@ -99,9 +216,11 @@ class DeleteDocument:
 
 
 class UpdateDocument:
+    def __init__(self, writer):
+        self.writer = writer
+
     def on_get(self, req, resp):
         try:
-            im = IndexManager()
             unique_field_value = req.get_param('primary-key')
             update_field_name = req.get_param('field')
             update_field_value = req.get_param('value')
@@ -109,14 +228,116 @@ class UpdateDocument:
                 raise ValueError(
                         'Error: field: {:s} value: {:s}'.
                         format(update_field_name, str(update_field_value)))
-            im.update_field('file_path', unique_field_value,
-                            update_field_name, update_field_value)
-
-            im.writer.commit()
+            self.writer.submit(IndexManager.update_field, 'file_path',
+                               unique_field_value, update_field_name,
+                               update_field_value).result()
             res = {'message': 'Update success'}
             resp.body = json.dumps(res, indent=4, ensure_ascii=False)
         except Exception as err:
             Config.logger.exception('Error in update db: %s', err)
+            req.context['error'] = True
+            print(err)
+            res = {'message': str(err)}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        return
+
+
+def _select_keys(im, key_field, keys, where):
+    """keys, or else key_field values of documents selected by where,
+    {FIELD: VALUE} matched exactly."""
+    if where is None:
+        return keys
+    if not isinstance(where, dict) or len(where) != 1:
+        raise ValueError('where must be one field and value: ' + str(where))
+    (field, value), = where.items()
+    return im.get_keys(key_field, field, value)
+
+
+def _bulk_update(im, key_field, keys, where, fields):
+    keys = _select_keys(im, key_field, keys, where)
+    return im.update_documents(key_field, keys, **fields)
+
+
+def _bulk_delete(im, gids, where, is_keep_file):
+    gids = _select_keys(im, 'gid', gids, where)
+    return im.delete_documents(gids, is_keep_file)
+
+
+class BulkUpdate:
+    """Update fields of documents in one commit, given by JSON
+    {"primary-key": "file_path", "keys": [...], "fields": {...}}.
+    "where": {FIELD: VALUE} selects documents of exactly the value
+    instead of "keys", e.g. {"title": TITLE} or {"gid": GID}.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def on_post(self, req, resp):
+        try:
+            body = load_json(req)
+            key_field = body.get('primary-key', 'file_path')
+            keys = body.get('keys', [])
+            where = body.get('where')
+            fields = body.get('fields')
+            if not fields:
+                raise ValueError('No fields to update')
+            results = self.writer.submit(_bulk_update, key_field, keys,
+                                         where, fields).result()
+            n_updated = len([r for r in results if r['status'] == 'updated'])
+            res = {'message': '{:d} of {:d} documents updated'.format(
+                       n_updated, len(results)),
+                   'results': results}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        except Exception as err:
+            Config.logger.exception('Error in bulk update: %s', err)
+            req.context['error'] = True
+            print(err)
+            res = {'message': str(err)}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        return
+
+
+class BulkDelete:
+    """Delete documents in one commit, given by JSON {"gids": [...]} or
+    {"where": {FIELD: VALUE}}, see BulkUpdate. Files are deleted unless
+    "keep-file" is true.
+    """
+    def __init__(self, writer):
+        self.writer = writer
+
+    def on_post(self, req, resp):
+        try:
+            body = load_json(req)
+            results = self.writer.submit(_bulk_delete, body.get('gids', []),
+                                         body.get('where'),
+                                         body.get('keep-file', False)).\
+                result()
+            n_deleted = len([r for r in results if r['status'] == 'deleted'])
+            res = {'message': '{:d} of {:d} documents deleted'.format(
+                       n_deleted, len(results)),
+                   'results': results}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        except Exception as err:
+            Config.logger.exception('Error in bulk delete: %s', err)
+            req.context['error'] = True
+            print(err)
+            res = {'message': str(err)}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        return
+
+
+class OptimizeIndex:
+    def __init__(self, writer):
+        self.writer = writer
+
+    def on_get(self, req, resp):
+        try:
+            stats = self.writer.submit(IndexManager.optimize).result()
+            res = {'message': 'Optimize success', 'index': stats}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        except Exception as err:
+            Config.logger.exception('Error in optimize: %s', err)
+            req.context['error'] = True
             print(err)
             res = {'message': str(err)}
             resp.body = json.dumps(res, indent=4, ensure_ascii=False)
@@ -124,7 +345,8 @@ class UpdateDocument:
 
 
 class SortedIndex:
-    search = Search()
+    def __init__(self, search):
+        self.search = search
 
     def on_get(self, req, resp):
         try:
@@ -152,16 +374,16 @@ class SortedIndex:
             else:
                 pagelen = int(pl)
 
+            compact = req.get_param('compact') == '1'
+
             res = self.search.get_sorted_index(field=field,
                                                n_page=n_result_page,
                                                pagelen=pagelen,
                                                reverse=reverse)
-            for row in res['rows']:
-                if 'published_at' not in row.keys():
-                    row['published_at'] = ''
-            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+            resp.body = dump_json(res, compact)
         except Exception as err:
             Config.logger.exception('Error in sorted index: %s', err)
+            req.context['error'] = True
             print(err)
             res = {'message': str(err)}
             resp.body = json.dumps(res, indent=4, ensure_ascii=False)
@@ -169,6 +391,33 @@ class SortedIndex:
 
 
 class CheckProgress:
+    """Progress message of text extraction, written to a file by electron,
+    then of adding to database, by jobs or else by --add-files process.
+    """
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def _get_job_state(self):
+        """Progress of running jobs, or else the end state of the last job,
+        as the progress file keeps it: Finished, Failed: ERROR or
+        Cancelled. None if no jobs.
+        """
+        jobs = self.jobs.list()
+        running = [job for job in jobs if not job.is_done()]
+        if running != []:
+            n_groups = sum(job.n_groups for job in running)
+            n_done = sum(job.n_done_groups for job in running)
+            if n_groups == 0:
+                return '...'
+            return str(round(n_done / n_groups * 100)) + '%'
+
+        if jobs == []:
+            return None
+        last = max(jobs, key=lambda job: job.finished_at or 0.0)
+        if last.status == 'failed':
+            return 'Failed: ' + str(last.error)
+        return last.status.capitalize()
+
     def on_get(self, req, resp):
         def _get_state(file_name):
             if os.path.exists(file_name):
@@ -188,34 +437,213 @@ class CheckProgress:
         state = _get_state('progress_text_extraction')
         if state not in ['', 'Finished']:
             message = 'Extracting texts: ' + state
-        elif state == 'Finished':
-            state = _get_state('progress_add_db')
-            if state in ['Finished', '']:
+        else:
+            job_state = self._get_job_state()
+            if job_state is not None:
+                state = job_state
+            elif state == 'Finished':
+                state = _get_state('progress_add_db')
+            if state in ['Finished', 'Cancelled', ''] or \
+                    state.startswith('Failed: '):
                 message = state
             else:
                 message = 'Adding to database: ' + state
-        else:
-            message = ''
 
         res = {'message': message}
         resp.body = json.dumps(res, indent=4, ensure_ascii=False)
         return
 
 
+class Jobs:
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def on_get(self, req, resp):
+        res = {'jobs': [job.to_dict() for job in self.jobs.list()]}
+        resp.body = dump_json(res, req.get_param('compact') == '1')
+
+    def on_post(self, req, resp):
+        """Start adding files, given by JSON {"files": [...], "lang": ...}.
+        lang is optional, and skips language detection. With "extract":
+        true, files are pdf files whose texts are extracted in python, and
+        "write_text": true also writes page text files.
+        """
+        try:
+            body = load_json(req)
+            files = body.get('files')
+            if not isinstance(files, list) or files == []:
+                raise ValueError('No files to add')
+            job = self.jobs.submit(files, body.get('lang'),
+                                   extract=body.get('extract', False),
+                                   write_text=body.get('write_text', False))
+            resp.status = falcon.HTTP_202
+            res = {'message': 'Job submitted', 'job': job.to_dict()}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        except Exception as err:
+            Config.logger.exception('Error in submit job: %s', err)
+            req.context['error'] = True
+            print(err)
+            res = {'message': str(err)}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        return
+
+
+class JobResource:
+    """Progress of a job. With wait=SECONDS, respond when the job changes
+    from version since=VERSION, or at timeout (long polling).
+
+    A waiting request holds a server thread, so at most max_polls requests
+    wait at a time, fewer than the server threads; others respond at once.
+    """
+    max_wait = 30.0
+
+    def __init__(self, jobs, max_polls=0):
+        self.jobs = jobs
+        self.polls = threading.Semaphore(max(max_polls, 0))
+
+    def on_get(self, req, resp, job_id):
+        try:
+            wait = min(float(req.get_param('wait') or 0), self.max_wait)
+            since = int(req.get_param('since') or -1)
+            if wait > 0 and self.polls.acquire(blocking=False):
+                try:
+                    job = self.jobs.wait(job_id, since, wait)
+                finally:
+                    self.polls.release()
+            else:
+                job = self.jobs.wait(job_id, since)
+            if job is None:
+                resp.status = falcon.HTTP_404
+                res = {'message': 'Job not found: ' + job_id}
+            else:
+                res = job.to_dict()
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        except Exception as err:
+            Config.logger.exception('Error in get job: %s', err)
+            req.context['error'] = True
+            print(err)
+            res = {'message': str(err)}
+            resp.body = json.dumps(res, indent=4, ensure_ascii=False)
+        return
+
+
+class ThreadPoolWSGIServer(simple_server.WSGIServer):
+    """WSGI server handling requests in a pool of worker threads, so that
+    a slow search does not block other requests.
+    """
+    def __init__(self, server_address, handler_class, threads):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread,
+                             request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+class MetricsResource:
+    def __init__(self, caches):
+        self.caches = caches  # name: ResultCache
+
+    def on_get(self, req, resp):
+        if req.get_param('format') == 'prometheus':
+            text = metrics.to_prometheus()
+            for name, cache in sorted(self.caches.items()):
+                for key, value in sorted(cache.stats().items()):
+                    text += 'mirusan_result_cache_{:s}{{cache="{:s}"}} {}\n'.\
+                            format(key, name, value)
+            resp.content_type = 'text/plain; version=0.0.4'
+            resp.body = text
+            return
+
+        res = metrics.to_dict()
+        res['result_caches'] = {name: cache.stats()
+                                for name, cache in self.caches.items()}
+        resp.body = dump_json(res, req.get_param('compact') == '1')
+
+
 class Server:
     def __init__(self):
-        api = falcon.API()
+        config = Config.get()
+        # one index handle for all searches, opened on the first one
+        self.search = Search()
+        self.writer = WriterService(
+                batch_size=config.get('writer_batch_size', 100),
+                batch_interval=config.get('writer_batch_interval', 0.5))
+        # keep the sorted index up to date with writes
+        self.writer.listeners.append(self.search.sorted_index.apply)
+        self.jobs = JobManager(self.writer,
+                               procs=config.get('extract_procs', 1))
+
+        # background compaction, disabled if interval is 0
+        self.compactor = None
+        if config.get('compact_interval', 0) > 0:
+            self.compactor = Compactor(
+                    self.writer,
+                    interval=config['compact_interval'],
+                    max_segments=config.get('compact_max_segments', 20),
+                    max_deleted_ratio=config.get('compact_max_deleted_ratio',
+                                                 0.2))
+
+        api = falcon.API(middleware=[TimingMiddleware()])
         api.add_route('/config', ConfigResource())
-        api.add_route('/search', SearchDB())
-        api.add_route('/sorted-index', SortedIndex())
-        api.add_route('/delete', DeleteDocument())
-        api.add_route('/progress', CheckProgress())
-        api.add_route('/update-document', UpdateDocument())
+        api.add_route('/search', SearchDB(self.search))
+        api.add_route('/sorted-index', SortedIndex(self.search))
+        api.add_route('/highlight', Highlight(self.search))
+        api.add_route('/delete', DeleteDocument(self.writer))
+        api.add_route('/progress', CheckProgress(self.jobs))
+        api.add_route('/jobs', Jobs(self.jobs))
+        # keep a server thread free of long polls
+        api.add_route('/jobs/{job_id}', JobResource(
+            self.jobs, max_polls=config.get('server_threads', 8) - 1))
+        api.add_route('/update-document', UpdateDocument(self.writer))
+        api.add_route('/bulk-update', BulkUpdate(self.writer))
+        api.add_route('/bulk-delete', BulkDelete(self.writer))
+        api.add_route('/optimize', OptimizeIndex(self.writer))
+        api.add_route('/metrics', MetricsResource(
+            {'search': self.search.cache}))
         self.api = api
 
+    def start_writer(self):
+        self.writer.start()
+        if self.compactor is not None:
+            self.compactor.start()
+
+    def stop_writer(self):
+        self.jobs.stop()
+        if self.compactor is not None:
+            self.compactor.stop()
+        self.writer.stop()
+
+    def make_server(self):
+        """Serve on localhost with server_threads worker threads set in
+        config.json. 1 falls back to single-threaded wsgiref server.
+        """
+        threads = Config.get().get('server_threads', 8)
+        if threads <= 1:
+            return simple_server.make_server("127.0.0.1", 8000, self.api)
+
+        httpd = ThreadPoolWSGIServer(("127.0.0.1", 8000),
+                                     simple_server.WSGIRequestHandler,
+                                     threads)
+        httpd.set_app(self.api)
+        return httpd
+
     def start(self):
         print('Start server.')
-        httpd = simple_server.make_server("127.0.0.1", 8000, self.api)
+        self.start_writer()
+        httpd = self.make_server()
         is_server_alive = True
 
         def check_alive():
@@ -229,10 +657,13 @@ class Server:
 
         threading.Thread(target=check_alive).start()
         httpd.serve_forever()
+        httpd.server_close()
+        self.stop_writer()
         print('Server is shut down.')
         is_server_alive = False
 
     def start_stand_alone(self):
         print('Start stand alone server.')
-        httpd = simple_server.make_server("127.0.0.1", 8000, self.api)
+        self.start_writer()
+        httpd = self.make_server()
         httpd.serve_forever()
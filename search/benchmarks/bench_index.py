@@ -0,0 +1,267 @@
+"""Benchmark of ingestion, search, sorted index and deletion on a synthetic
+corpus, in a temporary data directory.
+
+    python benchmarks/bench_index.py --documents 200 --pages 20 \
+        --save-baseline baseline.json
+    python benchmarks/bench_index.py --documents 200 --pages 20 \
+        --baseline baseline.json
+
+With --baseline, latencies slower than baseline by more than --tolerance
+are reported and the exit status is 1.
+
+With --analyzers, e.g. benchmarks/analyzers.json of {label: analyzer
+profiles}, the benchmark is run once per label, and index size and
+latencies are compared:
+
+    python benchmarks/bench_index.py --analyzers benchmarks/analyzers.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from config import Config
+
+import corpus
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024 / 1024  # bytes
+    return rss / 1024  # kilobytes
+
+
+def dir_size_mb(path):
+    size = 0
+    for root, _, files in os.walk(path):
+        size += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return size / 1024 / 1024
+
+
+def percentile(values, p):
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[k]
+
+
+def latency(times):
+    """Summary of a list of seconds, in milliseconds."""
+    return {'n': len(times),
+            'p50_ms': percentile(times, 50) * 1000,
+            'p99_ms': percentile(times, 99) * 1000,
+            'mean_ms': sum(times) / len(times) * 1000}
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def use_data_dir(data_dir):
+    """Point Config at a scratch data directory."""
+    Config.data_dir = data_dir
+    Config.database_dir = os.path.join(data_dir, 'database')
+    Config.pdf_dir = os.path.join(data_dir, 'pdf')
+    Config.txt_dir = os.path.join(data_dir, 'txt')
+    for d in [Config.database_dir, Config.pdf_dir, Config.txt_dir]:
+        os.makedirs(d, exist_ok=True)
+
+
+def run(args):
+    # import after Config is set up
+    import search
+    from search_manager import Search
+
+    langs = args.languages.split(',')
+    files = corpus.make_corpus(Config.pdf_dir, Config.txt_dir,
+                               n_documents=args.documents,
+                               n_pages=args.pages, langs=langs,
+                               n_words=args.words)
+    text_files = [f for f in files if f.endswith('.txt')]
+    n_bytes = sum(os.path.getsize(f) for f in text_files)
+
+    results = {'params': vars(args)}
+
+    t = timed(search.add_files, files, procs=args.procs)
+    results['ingest'] = {'seconds': t,
+                         'pages_per_s': len(text_files) / t,
+                         'bytes_per_s': n_bytes / t}
+    results['disk_mb'] = {
+            'text_files': n_bytes / 1024 / 1024,
+            'index': dir_size_mb(Config.database_dir),
+            'content_store': dir_size_mb(os.path.join(Config.data_dir,
+                                                      'content'))}
+
+    s = Search()
+    s.cache.maxsize = 0  # measure searches, not the result cache
+    rng = random.Random(0)
+    queries = [rng.choice(corpus.words(rng.choice(langs)))
+               for _ in range(args.queries)]
+
+    for pagelen in [int(p) for p in args.pagelens.split(',')]:
+        for sort_field in args.sort_fields.split(','):
+            times = [timed(s.search, q, sort_field=sort_field,
+                           pagelen=pagelen, highlight=True) for q in queries]
+            key = 'search:pagelen={:d}:sort={:s}'.format(pagelen, sort_field)
+            results[key] = latency(times)
+
+        times = [timed(s.search, q, sort_field='title', pagelen=pagelen)
+                 for q in queries]
+        key = 'search:pagelen={:d}:sort=title:no-highlight'.format(pagelen)
+        results[key] = latency(times)
+
+    for sort_field in ['title', 'created_at']:
+        n_index_pages = max(1, args.documents // 10)
+        times = [timed(s.get_sorted_index, sort_field,
+                       n_page=rng.randint(1, n_index_pages), pagelen=10)
+                 for _ in range(args.queries)]
+        results['sorted_index:sort=' + sort_field] = latency(times)
+    s.close()
+
+    titles = ['doc{:05d}'.format(i) for i in range(args.deletes)]
+    times = [timed(search.delete_by_title, title) for title in titles]
+    results['delete_by_title'] = latency(times)
+
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def run_in_data_dir(args):
+    data_dir = tempfile.mkdtemp(prefix='mirusan_bench_')
+    cwd = os.getcwd()
+    try:
+        use_data_dir(data_dir)
+        os.chdir(data_dir)  # progress files
+        return run(args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(data_dir)
+
+
+def run_analyzers(args):
+    """Results of each set of analyzer profiles of args.analyzers."""
+    with open(args.analyzers) as f:
+        profile_sets = json.load(f)
+    base = Config.get().get('analyzers', {})
+    results = {}
+    try:
+        for label, profiles in profile_sets.items():
+            Config.get()['analyzers'] = dict(base, **profiles)
+            results[label] = run_in_data_dir(args)
+    finally:
+        Config.get()['analyzers'] = base
+    return results
+
+
+def print_comparison(results):
+    labels = list(results.keys())
+    rows = [('index_mb', lambda r: r['disk_mb']['index']),
+            ('ingest_s', lambda r: r['ingest']['seconds'])]
+    for key, value in results[labels[0]].items():
+        if isinstance(value, dict) and 'p50_ms' in value:
+            rows.append((key + ' p50_ms',
+                         lambda r, key=key: r[key]['p50_ms']))
+
+    print('{:48s}'.format('') + ''.join('{:>16s}'.format(label[:15])
+                                        for label in labels))
+    for name, get in rows:
+        print('{:48s}'.format(name) + ''.join(
+            '{:16.2f}'.format(get(results[label])) for label in labels))
+
+
+def compare(results, baseline, tolerance, min_delta_ms=1.0):
+    """Return descriptions of latencies regressed from baseline by more than
+    tolerance (ratio) and min_delta_ms, to ignore noise of fast calls.
+    """
+    regressions = []
+    for key, value in results.items():
+        if key not in baseline or not isinstance(value, dict):
+            continue
+        for metric in ['p50_ms', 'p99_ms', 'seconds']:
+            if metric not in value or metric not in baseline[key]:
+                continue
+            base = baseline[key][metric]
+            delta_ms = value[metric] - base
+            if metric == 'seconds':
+                delta_ms *= 1000
+            if value[metric] > base * (1 + tolerance) and \
+                    delta_ms > min_delta_ms:
+                regressions.append('{:s} {:s}: {:.2f} -> {:.2f}'.format(
+                    key, metric, base, value[metric]))
+    return regressions
+
+
+def print_results(results):
+    for key, value in results.items():
+        if key == 'params':
+            continue
+        if isinstance(value, dict):
+            value = ', '.join('{:s}={:.2f}'.format(k, v) if type(v) is float
+                              else '{:s}={}'.format(k, v)
+                              for k, v in value.items())
+        print('{:40s} {}'.format(key, value))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', default=100, type=int)
+    parser.add_argument('--pages', default=20, type=int)
+    parser.add_argument('--words', default=300, type=int,
+                        help='Words per page')
+    parser.add_argument('--languages', default='en,ja')
+    parser.add_argument('--procs', default=1, type=int)
+    parser.add_argument('--queries', default=50, type=int)
+    parser.add_argument('--pagelens', default='10,50')
+    parser.add_argument('--sort-fields', default='title,page')
+    parser.add_argument('--deletes', default=5, type=int)
+    parser.add_argument('--output', default=None, help='Write results json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--save-baseline', default=None)
+    parser.add_argument('--tolerance', default=0.2, type=float)
+    parser.add_argument('--min-delta-ms', default=1.0, type=float)
+    parser.add_argument('--analyzers', default=None,
+                        help='Compare sets of analyzer profiles of a json '
+                             'file {label: profiles}')
+    args = parser.parse_args()
+
+    if args.analyzers is not None:
+        results = run_analyzers(args)
+        print_comparison(results)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=4)
+        return
+
+    results = run_in_data_dir(args)
+    print_results(results)
+
+    for path in [args.output, args.save_baseline]:
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(results, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance,
+                              args.min_delta_ms)
+        for r in regressions:
+            print('Regression: ' + r)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Benchmark of helper.separate_files at large file counts.
+
+    python benchmarks/bench_separate_files.py --pdfs 5000 --pages 60
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from helper import separate_files
+
+
+def make_files(n_pdfs, n_pages):
+    """File list as given from electron, titles sharing prefixes and
+    containing regex metacharacters.
+    """
+    files = []
+    for i in range(n_pdfs):
+        title = 'doc{:d} (v1.0)+'.format(i)
+        files.append(os.path.join('pdf', title + '.pdf'))
+        for n in range(1, n_pages + 1):
+            files.append(os.path.join('txt', title,
+                                      '{:s}_p{:d}.txt'.format(title, n)))
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pdfs', default=5000, type=int)
+    parser.add_argument('--pages', default=60, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    args = parser.parse_args()
+
+    files = make_files(args.pdfs, args.pages)
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        groups = separate_files(files)
+        times.append(time.perf_counter() - start)
+
+    assert len(groups) == args.pdfs
+    assert all(len(g['text_files']) == args.pages for g in groups)
+    print('separate_files: {:d} pdfs, {:d} files: best {:.3f} s'.format(
+        args.pdfs, len(files), min(times)))
+
+
+if __name__ == '__main__':
+    main()
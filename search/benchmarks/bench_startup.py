@@ -0,0 +1,104 @@
+"""Benchmark of server startup, which the electron app waits on: time
+from spawning search.py --server until it responds, and until its first
+search responds, on a synthetic corpus in a temporary directory.
+
+    python benchmarks/bench_startup.py --documents 100 --repeat 5
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.append(os.path.dirname(__file__))
+
+import corpus
+
+SEARCH_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+SEARCH_PY = os.path.join(SEARCH_DIR, 'search.py')
+URL = 'http://127.0.0.1:8000'
+
+
+def wait_response(url, timeout):
+    """Poll url until it responds. Return the time it responded."""
+    end = time.perf_counter() + timeout
+    while time.perf_counter() < end:
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as res:
+                res.read()
+            return time.perf_counter()
+        except OSError:
+            time.sleep(0.005)
+    raise TimeoutError(url)
+
+
+def start_server(data_dir, query, timeout):
+    """Seconds until the server responds, and until its first search."""
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, SEARCH_PY, '--server',
+                             '--stand-alone'], cwd=data_dir,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    try:
+        ready = wait_response(URL + '/config', timeout)
+        searched = wait_response(URL + '/search?q=' + query, timeout)
+    finally:
+        proc.terminate()
+        proc.wait()
+    return ready - start, searched - start
+
+
+def import_time(data_dir, module):
+    """Seconds to import module in a new interpreter."""
+    code = ('import sys, time; sys.path.insert(0, {!r}); '
+            'start = time.perf_counter(); import {:s}; '
+            'print(time.perf_counter() - start)').format(SEARCH_DIR, module)
+    out = subprocess.check_output([sys.executable, '-c', code], cwd=data_dir)
+    return float(out.decode().split()[-1])
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--documents', default=100, type=int)
+    parser.add_argument('--pages', default=20, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--timeout', default=60.0, type=float)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='mirusan_bench_')
+    try:
+        # paths of config.json are relative to the working directory
+        pdf_dir = os.path.join(data_dir, 'data', 'pdf')
+        txt_dir = os.path.join(data_dir, 'data', 'txt')
+        os.makedirs(pdf_dir)
+        os.makedirs(txt_dir)
+        corpus.make_corpus(pdf_dir, txt_dir, n_documents=args.documents,
+                           n_pages=args.pages)
+        subprocess.check_call([sys.executable, SEARCH_PY, '--add-dir'],
+                              cwd=data_dir, stdout=subprocess.DEVNULL)
+
+        query = corpus.words('en')[3]
+        times = [start_server(data_dir, query, args.timeout)
+                 for _ in range(args.repeat)]
+        for module in ['api_server', 'search']:
+            t = median([import_time(data_dir, module)
+                        for _ in range(args.repeat)])
+            print('{:40s} {:.1f} ms'.format('import ' + module, t * 1000))
+    finally:
+        shutil.rmtree(data_dir)
+
+    print('{:40s} {:.1f} ms'.format('server ready',
+                                    median([t[0] for t in times]) * 1000))
+    print('{:40s} {:.1f} ms'.format('first search',
+                                    median([t[1] for t in times]) * 1000))
+
+
+if __name__ == '__main__':
+    main()
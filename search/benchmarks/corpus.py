@@ -0,0 +1,56 @@
+"""Synthetic corpus of pdf placeholder files and page-wise text files,
+laid out as electron does: pdf_dir/{NAME}.pdf, txt_dir/{NAME}/{NAME}_p{N}.txt
+"""
+import os
+import random
+
+# Sentences to draw words from, so that langdetect detects the language
+SAMPLES = {
+    'en': 'the search engine reads every page of the document and builds '
+          'an index of words so that a query returns the pages where '
+          'those words appear together with a short highlighted snippet',
+    'de': 'die suchmaschine liest jede seite des dokuments und baut einen '
+          'index der wörter damit eine anfrage die seiten liefert auf denen '
+          'diese wörter zusammen mit einem kurzen ausschnitt erscheinen',
+    'fr': 'le moteur de recherche lit chaque page du document et construit '
+          'un index des mots afin qu une requête renvoie les pages où ces '
+          'mots apparaissent avec un court extrait mis en évidence',
+    'ja': '検索 エンジン は 文書 の すべて の ページ を 読み 単語 の 索引 を '
+          '作り 問い合わせ に 対して その 単語 が 現れる ページ と 強調 された '
+          '短い 抜粋 を 返す',
+}
+
+
+def words(lang):
+    return SAMPLES[lang].split()
+
+
+def make_page(rng, lang, n_words):
+    vocabulary = words(lang)
+    separator = '' if lang == 'ja' else ' '
+    return separator.join(rng.choice(vocabulary) for _ in range(n_words))
+
+
+def make_corpus(pdf_dir, txt_dir, n_documents=100, n_pages=20,
+                langs=('en', 'ja'), n_words=300, seed=0):
+    """Write the corpus, return list of all file paths as --add-files takes.
+    Document i is in language langs[i % len(langs)].
+    """
+    rng = random.Random(seed)
+    files = []
+    for i in range(n_documents):
+        name = 'doc{:05d}'.format(i)
+        lang = langs[i % len(langs)]
+        pdf_file = os.path.join(pdf_dir, name + '.pdf')
+        with open(pdf_file, 'w'):
+            pass
+        files.append(pdf_file)
+
+        doc_dir = os.path.join(txt_dir, name)
+        os.makedirs(doc_dir, exist_ok=True)
+        for n in range(1, n_pages + 1):
+            text_file = os.path.join(doc_dir, '{:s}_p{:d}.txt'.format(name, n))
+            with open(text_file, 'w', encoding='utf-8') as f:
+                f.write(make_page(rng, lang, n_words))
+            files.append(text_file)
+    return files
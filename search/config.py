@@ -53,26 +53,32 @@ class Config:
 
     logger = create_logger(debug)
 
-    def check_and_create_dir(dirpath, logger):
-        if not os.path.exists(dirpath):
-            logger.info('Create dir: ' + dirpath)
-            os.mkdir(dirpath)
-
     data_dir = config['data_dir']
     if data_dir == '':
         raise ValueError('data_dir is not properly set in config file.')
 
-    check_and_create_dir(data_dir, logger)
-
     database_dir = os.path.join(data_dir, 'database')
-    check_and_create_dir(database_dir, logger)
-
     pdf_dir = config['pdf_dir']
-    check_and_create_dir(pdf_dir, logger)
-
     txt_dir = config['txt_dir']
-    check_and_create_dir(txt_dir, logger)
 
     @classmethod
     def get(cls):
         return cls.config
+
+    @classmethod
+    def save(cls):
+        """Write the config to its config.json."""
+        config = {key: value for key, value in cls.config.items()
+                  if key != 'config_file_path'}
+        with open(cls.config['config_file_path'], 'w') as f:
+            f.write(json.dumps(config, indent=4, ensure_ascii=False) + '\n')
+
+    @classmethod
+    def create_dirs(cls):
+        """Create data directories if not exist. Called on demand, not on
+        import, e.g. not for searching an existing index."""
+        for dirpath in [cls.data_dir, cls.database_dir, cls.pdf_dir,
+                        cls.txt_dir]:
+            if not os.path.exists(dirpath):
+                cls.logger.info('Create dir: ' + dirpath)
+                os.makedirs(dirpath)
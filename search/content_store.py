@@ -0,0 +1,218 @@
+from config import Config
+
+from collections import OrderedDict
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+import zlib
+
+# Record header: sha1 digest of the text, size of the compressed text
+HEADER = struct.Struct('>20sI')
+
+# Ratio of dead records in a file above which compact() rewrites it
+MAX_DEAD_RATIO = 0.2
+
+
+class ContentStore:
+    """Page texts, compressed, in a file per document group (gid).
+
+    A file is a sequence of records, header and zlib-compressed utf-8 text,
+    and a page is addressed by the reference (offset, size) of its record
+    data, stored in the index. Records are appended, and identical texts
+    of a document are stored once. Records of changed or deleted pages are
+    removed by compact(), which moves the others; references made before
+    are then looked up by the digest of their text. Files are read by
+    mmap, and at most max_maps files are kept mapped.
+    """
+    def __init__(self, content_dir=None, max_maps=64):
+        if content_dir is None:
+            content_dir = os.path.join(Config.data_dir, 'content')
+        self.content_dir = content_dir
+        self.max_maps = max_maps
+        self.lock = threading.Lock()
+        self.maps = OrderedDict()  # gid: mmap, least recently used first
+        self.hashes = {}  # gid: {sha1 digest: reference}, for writing
+        self.moved = {}  # gid: {sha1 digest: reference}, after compact()
+
+    def path(self, gid):
+        if re.match(r'^[\w-]+$', gid) is None:
+            gid = hashlib.sha1(gid.encode('utf-8')).hexdigest()
+        return os.path.join(self.content_dir, gid + '.pages')
+
+    def _read_hashes(self, gid):
+        hashes = {}
+        path = self.path(gid)
+        if not os.path.exists(path):
+            return hashes
+        with open(path, 'rb') as f:
+            for digest, offset, size in self._records(f):
+                hashes[digest] = (offset, size)
+        return hashes
+
+    def _records(self, f):
+        """Yield (digest, offset, size) of the records of file f."""
+        offset = 0
+        while True:
+            f.seek(offset)
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                break
+            digest, size = HEADER.unpack(header)
+            offset += HEADER.size
+            yield digest, offset, size
+            offset += size
+
+    def put(self, gid, text, content_hash):
+        """Store text of document group gid, unless the same text is
+        stored. content_hash: hex sha1 of text. Return its reference.
+        """
+        if gid not in self.hashes:
+            self.hashes[gid] = self._read_hashes(gid)
+        hashes = self.hashes[gid]
+        digest = bytes.fromhex(content_hash)
+        if digest in hashes:
+            return hashes[digest]
+
+        data = zlib.compress(text.encode('utf-8'))
+        os.makedirs(self.content_dir, exist_ok=True)
+        with open(self.path(gid), 'ab') as f:
+            offset = f.tell() + HEADER.size
+            f.write(HEADER.pack(digest, len(data)) + data)
+        hashes[digest] = (offset, len(data))
+        return hashes[digest]
+
+    def delete(self, gid):
+        """Delete texts of document group gid."""
+        self.hashes.pop(gid, None)
+        with self.lock:
+            self.maps.pop(gid, None)
+        path = self.path(gid)
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as err:  # mapped by another process on windows
+            Config.logger.warning('Could not delete %s: %s', path, err)
+
+    def _map(self, gid, end):
+        """mmap of the file of gid, at least end bytes long."""
+        with self.lock:
+            m = self.maps.get(gid)
+            if m is not None and len(m) >= end:
+                self.maps.move_to_end(gid)
+                return m
+
+            # not mapped yet, or appended since mapped
+            with open(self.path(gid), 'rb') as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[gid] = m
+            self.maps.move_to_end(gid)
+            # evicted maps are closed when no longer read
+            while len(self.maps) > self.max_maps:
+                self.maps.popitem(last=False)
+            return m
+
+    def get(self, gid, ref, content_hash=None):
+        """Text of reference ref in document group gid. With content_hash,
+        hex sha1 of the text, a reference made before compact() is looked
+        up by it.
+        """
+        if content_hash is not None:
+            digest = bytes.fromhex(content_hash)
+            if not self._is_record(gid, ref, digest):
+                ref = self._find(gid, digest)
+        offset, size = ref
+        m = self._map(gid, offset + size)
+        return zlib.decompress(m[offset:offset + size]).decode('utf-8')
+
+    def _is_record(self, gid, ref, digest):
+        offset, size = ref
+        if offset < HEADER.size:
+            return False
+        m = self._map(gid, offset + size)
+        return m[offset - HEADER.size:offset] == HEADER.pack(digest, size)
+
+    def _find(self, gid, digest):
+        """Reference of the text of digest, moved by compact()."""
+        ref = self.moved.get(gid, {}).get(digest)
+        if ref is not None and self._is_record(gid, ref, digest):
+            return ref
+        with self.lock:
+            self.maps.pop(gid, None)  # may map the file before compact()
+        self.moved[gid] = self._read_hashes(gid)
+        if digest not in self.moved[gid]:
+            raise FileNotFoundError('Text not found in ' + self.path(gid))
+        return self.moved[gid][digest]
+
+    def compact(self, gid, content_hashes, max_dead_ratio=MAX_DEAD_RATIO):
+        """Rewrite the file of gid with only the texts of content_hashes,
+        e.g. of its pages in the index, if other records take more than
+        max_dead_ratio of the file. Return the number of bytes removed.
+        """
+        path = self.path(gid)
+        if not os.path.exists(path):
+            return 0
+        digests = {bytes.fromhex(h) for h in content_hashes}
+        records = []  # header and data of live records
+        with open(path, 'rb') as f:
+            for digest, offset, size in self._records(f):
+                if digest in digests:
+                    digests.discard(digest)
+                    f.seek(offset)
+                    records.append((HEADER.pack(digest, size), f.read(size)))
+        n_all = os.path.getsize(path)
+        n_dead = n_all - sum(len(h) + len(d) for h, d in records)
+        if n_dead <= n_all * max_dead_ratio:
+            return 0
+
+        hashes = {}
+        with open(path + '.tmp', 'wb') as f:
+            for header, data in records:
+                f.write(header)
+                hashes[HEADER.unpack(header)[0]] = (f.tell(), len(data))
+                f.write(data)
+        with self.lock:
+            self.maps.pop(gid, None)
+        try:
+            os.replace(path + '.tmp', path)
+        except OSError as err:  # mapped by another process on windows
+            Config.logger.warning('Could not compact %s: %s', path, err)
+            os.remove(path + '.tmp')
+            return 0
+        self.hashes[gid] = hashes
+        self.moved[gid] = hashes
+        return n_dead
+
+    def page_text(self, stored):
+        """Text of a page document of stored fields, from the index if
+        stored there (indexes created before the ContentStore), or from
+        the store. None if language is unknown, or the text is deleted.
+        """
+        if stored.get('language') is None:
+            return None
+        content_field_name = 'content_' + stored['language']
+        if content_field_name in stored:
+            return stored[content_field_name]
+        if 'text_ref' not in stored:
+            return None
+        try:
+            return self.get(stored['gid'], stored['text_ref'],
+                            stored.get('content_hash'))
+        except FileNotFoundError:  # document deleted since searched
+            return None
+
+    def clear(self):
+        """Unmap files, e.g. after documents are deleted or replaced."""
+        with self.lock:
+            self.maps = OrderedDict()
+        self.hashes = {}
+        self.moved = {}
+
+    def size(self):
+        """Total bytes of stored files."""
+        if not os.path.exists(self.content_dir):
+            return 0
+        return sum(entry.stat().st_size
+                   for entry in os.scandir(self.content_dir))
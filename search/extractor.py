@@ -0,0 +1,81 @@
+import importlib.util
+import re
+
+
+def is_available():
+    """pdfminer.six is optional, only for extracting texts in python. It
+    is imported on first use."""
+    return importlib.util.find_spec('pdfminer') is not None
+
+
+def check_available():
+    if not is_available():
+        raise ImportError('Text extraction requires pdfminer.six: '
+                          'pip install pdfminer.six')
+
+
+def clean_text(text):
+    """Join lines broken by layout, as pdf2txt.js does. Spaces next to
+    non-ascii characters are removed.
+    """
+    # keep some expressions
+    keeps = [('。\n', '#punctNewLine'), ('\n\n', '#doubleNewLine'),
+             ('\n　', '#newLineSpace')]
+    for expr, key in keeps:
+        text = text.replace(expr, key)
+
+    text = text.replace('\n', ' ')
+    text = re.sub(r'([^\x00-\x7F]) +', r'\1', text)
+    text = re.sub(r' +([^\x00-\x7F])', r'\1', text)
+    text = re.sub(r' +', ' ', text)
+
+    for expr, key in keeps:
+        text = text.replace(key, expr)
+    return text.strip()
+
+
+def count_pages(pdf_file_path):
+    from pdfminer.pdfpage import PDFPage
+    with open(pdf_file_path, 'rb') as f:
+        return sum(1 for _ in PDFPage.get_pages(f))
+
+
+def extract_page_range(pdf_file_path, first, last):
+    """Texts of pages first to last (1-origin, inclusive), as a list of
+    (page number, text). Opens the pdf once per range, so that a worker
+    process extracts a chunk of pages at a time.
+    """
+    from pdfminer.high_level import extract_pages
+    from pdfminer.layout import LTTextContainer
+
+    pages = []
+    layouts = extract_pages(pdf_file_path,
+                            page_numbers=range(first - 1, last))
+    for num_page, layout in enumerate(layouts, first):
+        text = ''.join(element.get_text() for element in layout
+                       if isinstance(element, LTTextContainer))
+        pages.append((num_page, clean_text(text)))
+    return pages
+
+
+def _extract_task(task):
+    return task[0], extract_page_range(*task)
+
+
+def _tasks(pdf_file_paths, chunk_size):
+    for pdf_file_path in pdf_file_paths:
+        n_pages = count_pages(pdf_file_path)
+        for first in range(1, n_pages + 1, chunk_size):
+            yield pdf_file_path, first, min(first + chunk_size - 1, n_pages)
+
+
+def iter_page_chunks(pdf_file_paths, pool=None, chunk_size=10):
+    """Yield (pdf file path, [(page number, text), ...]) of chunk_size
+    pages, in order of files and pages. With a process pool, chunks are
+    extracted in parallel, and yielded as soon as they are in order.
+    """
+    check_available()
+    tasks = _tasks(pdf_file_paths, chunk_size)
+    if pool is None:
+        return map(_extract_task, tasks)
+    return pool.imap(_extract_task, tasks)
@@ -4,16 +4,45 @@ import uuid
 import re
 
 
+PAGE_FILE_NAME = re.compile(r'(.+)_p(\d+)\.(?:txt|TXT)$')
+
+
 def normalize(string):
     return unicodedata.normalize('NFKC', string)
 
 
+def is_in_dir(path, directory):
+    """Whether path is in directory or its subdirectories."""
+    path = os.path.realpath(path)
+    directory = os.path.realpath(directory)
+    return os.path.commonpath([path, directory]) == directory
+
+
+def split_page_file_name(file_name):
+    """Return (document name, page number) of page-wise text file name
+    {DOCUMENT_NAME}_p{NUM_PAGE}.txt, or None if not in this format.
+    """
+    m = PAGE_FILE_NAME.match(file_name)
+    if m is None:
+        return None
+    return m.group(1), int(m.group(2))
+
+
 def separate_files(files):
+    """Group pdf files with their page-wise text files
+    {DOCUMENT_NAME}_p{NUM_PAGE}.txt, by exact document name.
+    Text files are indexed by document name in one pass.
+    """
     pdfs = []
+    text_files = {}
     for file in files:
         filename, ext = os.path.splitext(file)
         if ext in ['.pdf', '.PDF']:
             pdfs.append(file)
+        else:
+            name_page = split_page_file_name(os.path.basename(file))
+            if name_page is not None:
+                text_files.setdefault(name_page[0], []).append(file)
 
     groups = []
     for pdf in pdfs:
@@ -23,12 +52,35 @@ def separate_files(files):
         # assign random uuid for document group
         group['id'] = str(uuid.uuid4())
         group['pdf_file'] = pdf
-        group['text_files'] = []
-        for file in files:
-            filename, ext = os.path.splitext(file)
-            if ext in ['.txt', '.TXT']:
-                if re.search(r'^' + title, os.path.basename(filename)):
-                    group['text_files'].append(file)
+        group['text_files'] = list(text_files.get(title, []))
         groups.append(group)
 
     return groups
+
+
+def iter_document_groups(pdf_dir, txt_dir):
+    """Yield document groups, as separate_files() does, of the pdf files in
+    pdf_dir and their page-wise text files anywhere under txt_dir.
+    Text files are collected by document name in one walk of txt_dir,
+    and groups are yielded while scanning pdf_dir. Paths are absolute,
+    as those added from electron.
+    """
+    text_files = {}
+    for root, _, files in os.walk(os.path.abspath(txt_dir)):
+        for file in files:
+            name_page = split_page_file_name(file)
+            if name_page is not None:
+                name, num_page = name_page
+                text_files.setdefault(name, []).append(
+                        (num_page, os.path.join(root, file)))
+
+    for entry in os.scandir(os.path.abspath(pdf_dir)):
+        title, ext = os.path.splitext(entry.name)
+        if ext not in ['.pdf', '.PDF'] or not entry.is_file():
+            continue
+        group = {}
+        group['id'] = str(uuid.uuid4())
+        group['pdf_file'] = entry.path
+        group['text_files'] = [tf for _, tf in
+                               sorted(text_files.get(title, []))]
+        yield group
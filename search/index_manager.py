@@ -1,83 +1,361 @@
 from config import Config
-from helper import normalize
+from content_store import ContentStore
+from helper import is_in_dir, normalize, split_page_file_name
+from metrics import metrics
 
 from whoosh.index import create_in, open_dir, exists_in
-from whoosh.fields import TEXT, DATETIME, NUMERIC, KEYWORD, ID, Schema
-from whoosh.analysis import NgramTokenizer, StandardAnalyzer, LanguageAnalyzer
+from whoosh.columns import VarBytesColumn
+from whoosh.fields import TEXT, DATETIME, NUMERIC, KEYWORD, ID, STORED, \
+    COLUMN, Schema
+from whoosh.analysis import NgramTokenizer, StandardAnalyzer, \
+    StemmingAnalyzer, LanguageAnalyzer
 from whoosh.lang import languages
 from whoosh.qparser import QueryParser
-from whoosh.query import Every
-
-from dateutil.parser import parse
 
+from collections import OrderedDict
 import os
 import datetime
-import re
-import langdetect
+import hashlib
+import uuid
+
+# Number of characters language is detected from
+LANG_SAMPLE_SIZE = 2000
+
+# Fields with a sort key column {field}_key
+SORT_KEY_FIELDS = ['title', 'authors', 'publisher']
+
+# Text fields analyzed by the metadata profile
+METADATA_FIELDS = ['title', 'authors', 'publisher', 'summary', 'memo']
+
+# Analyzer profiles, overridden by "analyzers" of config.json. Content of a
+# language is analyzed by the profile of its code, or else by "stemming"
+# if whoosh has a stemmer for it, or else by "default".
+ANALYZER_PROFILES = {
+    'metadata': {'analyzer': 'ngram', 'ngram_min': 1, 'ngram_max': 2},
+    'en': {'analyzer': 'standard', 'stopwords': True},
+    'stemming': {'analyzer': 'language'},
+    'default': {'analyzer': 'ngram', 'ngram_min': 1, 'ngram_max': 2}}
+
+
+def load_langdetect():
+    """Import langdetect on first use, not to slow down processes only
+    searching."""
+    import langdetect
+    from langdetect.detector_factory import DetectorFactory
+
+    # Make detection deterministic
+    DetectorFactory.seed = 0
+    return langdetect
+
+
+def detect_lang(text, sample_size=LANG_SAMPLE_SIZE):
+    try:
+        lang = load_langdetect().detect(text[:sample_size])
+        return lang
+    except:
+        return None
+
+
+def detect_group_lang(text_file_paths, sample_size=LANG_SAMPLE_SIZE):
+    """Detect language of a document group once, from the first
+    sample_size characters of its text files. Pages of a document are
+    assumed to be in the same language.
+    """
+    sample = ''
+    for text_file_path in text_file_paths:
+        text, _ = read_text_file(text_file_path, detect=False)
+        sample += text + '\n'
+        if len(sample) >= sample_size:
+            break
+    return detect_lang(sample, sample_size)
+
+
+def read_text_file(text_file_path, detect=True):
+    """Read text file, return normalized text and its language (None if
+    not detected). Mapped over text files by the pool of add_files.
+    """
+    with open(text_file_path, 'r', encoding='utf-8') as f:
+        content_text = f.read()
+
+    content_text_normalized = normalize(content_text)
+    if not detect:
+        return content_text_normalized, None
+    return content_text_normalized, detect_lang(content_text_normalized)
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def upgrade_fields():
+    """Fields of the schema newer than the first indexes, added to them
+    when opened by IndexManager:
+    content_hash, mtime: to detect changed text files
+    text_ref: reference to the page text in the ContentStore
+    {field}_key: sort key columns of SORT_KEY_FIELDS
+    """
+    fields = {'content_hash': ID(stored=True),
+              'mtime': STORED(),
+              'text_ref': STORED()}
+    for name in SORT_KEY_FIELDS:
+        fields[name + '_key'] = COLUMN(VarBytesColumn())
+    return fields
+
+
+def has_added_documents(writer):
+    """Whether writer, a SegmentWriter or an MpWriter, holds documents
+    added since opened. whoosh has no public API for it; the flags are
+    private attributes of whoosh 2.7.
+    """
+    return writer._added or getattr(writer, '_added_sub', False)
+
+
+def sort_key(text):
+    """Compact key to sort texts by: normalized and case folded."""
+    return normalize(text).casefold().encode('utf-8')
+
+
+def with_sort_keys(fields):
+    """Copy of fields, with sort keys of its SORT_KEY_FIELDS."""
+    fields = dict(fields)
+    for name in SORT_KEY_FIELDS:
+        if isinstance(fields.get(name), str):
+            fields[name + '_key'] = sort_key(fields[name])
+    return fields
+
+
+def index_stats(ix):
+    """Number of segments, documents and deleted documents of index ix.
+    Segments are the leaf readers of its reader; an empty index has one
+    reader without documents.
+    """
+    with ix.reader() as reader:
+        n_segments = len([r for r, _ in reader.leaf_readers()
+                          if r.doc_count_all() > 0])
+        n_all = reader.doc_count_all()
+        n_deleted = n_all - reader.doc_count()
+    return {'segments': n_segments,
+            'documents': n_all - n_deleted,
+            'deleted_documents': n_deleted,
+            'deleted_ratio': n_deleted / n_all if n_all > 0 else 0.0}
+
+
+def export_fields(stored, content_store):
+    """Stored fields of a document as a JSON-serializable dict, with its
+    page text as 'content' instead of a reference to the ContentStore.
+    """
+    content_field_name = 'content_' + str(stored.get('language'))
+    doc = {}
+    for name, value in stored.items():
+        if name in ['text_ref', content_field_name]:
+            continue
+        if isinstance(value, datetime.datetime):
+            value = value.isoformat()
+        doc[name] = value
+    if stored.get('document_format') == 'txt':
+        doc['content'] = content_store.page_text(stored)
+    return doc
+
+
+def supported_languages():
+    """Languages langdetect can detect."""
+    from langdetect.detector_factory import PROFILES_DIRECTORY
+    return sorted(os.listdir(PROFILES_DIRECTORY))
+
+
+def analyzer_profiles():
+    return dict(ANALYZER_PROFILES, **Config.get().get('analyzers', {}))
+
+
+def make_analyzer(profile, lang=None):
+    """Analyzer of a profile:
+    ngram: n-grams of ngram_min to ngram_max characters
+    standard: words, without English stop words if stopwords
+    stemming: standard, and English words stemmed
+    language: words of lang, stemmed and without its stop words
+    """
+    name = profile.get('analyzer')
+    options = {} if profile.get('stopwords', True) else {'stoplist': None}
+    if name == 'ngram':
+        return NgramTokenizer(minsize=profile.get('ngram_min', 1),
+                              maxsize=profile.get('ngram_max', 2))
+    elif name == 'standard':
+        return StandardAnalyzer(**options)
+    elif name == 'stemming':
+        return StemmingAnalyzer(**options)
+    elif name == 'language':
+        return LanguageAnalyzer(lang)
+    raise ValueError('Unknown analyzer: ' + str(name))
+
+
+def metadata_analyzer():
+    return make_analyzer(analyzer_profiles()['metadata'])
+
+
+def content_field(lang):
+    """Field type of language-wise content field. Texts are not stored in
+    the index, but in the ContentStore."""
+    profiles = analyzer_profiles()
+    if lang in profiles:
+        profile = profiles[lang]
+    elif lang in languages:
+        profile = profiles['stemming']
+    else:
+        profile = profiles['default']
+    return TEXT(analyzer=make_analyzer(profile, lang))
+
+
+def changed_analyzers(schema):
+    """Text fields of schema analyzed otherwise than by the profiles, and
+    content fields storing texts in the index, of indexes created before
+    the ContentStore; reindexing moves their texts to the store.
+    """
+    changed = []
+    for name in schema.names():
+        if name in METADATA_FIELDS:
+            analyzer = metadata_analyzer()
+        elif name.startswith('content_') and isinstance(schema[name], TEXT):
+            if schema[name].stored:
+                changed.append(name)
+                continue
+            analyzer = content_field(name[len('content_'):]).analyzer
+        else:
+            continue
+        if schema[name].analyzer != analyzer:
+            changed.append(name)
+    return changed
+
+
+def ensure_index():
+    """Create data directories and the index if not exist, without taking
+    the writer lock."""
+    Config.create_dirs()
+    if not exists_in(Config.database_dir):
+        IndexManager.create_index()
 
 
 class IndexManager:
-    def __init__(self, limitmb=256, procs=1):
+    def __init__(self, limitmb=256, procs=1, timeout=0.0, database_dir=None):
+        """database_dir: of the index, Config.database_dir if None, e.g.
+        another for an index being rebuilt."""
         # Initialize db if not exist
-        if not exists_in(Config.database_dir):
-            self.create_index()
-
-        self.ix = open_dir(Config.database_dir)
-        self.writer = self.ix.writer(limitmb=limitmb, procs=procs)
+        Config.create_dirs()
+        if database_dir is None:
+            database_dir = Config.database_dir
+        self.database_dir = database_dir
+        if not exists_in(database_dir):
+            self.create_index(database_dir)
+
+        self.limitmb = limitmb
+        self.procs = procs
+        self.timeout = timeout
+        self.langs = {}  # gid: language of the document
+        self.searcher = None
+        self.pdf_changes = {}  # gid: stored fields of pdf, None if deleted
+        self.content_store = ContentStore()
+        self.deleted_gids = set()  # texts to delete from content_store
+        self.mtime_updates = {}  # text file path: mtime, see update_mtimes()
+        self.open()
+        self.add_fields(upgrade_fields())
 
     def open(self):
-        self.ix = open_dir(Config.database_dir)
-        self.writer = self.ix.writer()
+        """Open index and writer. procs > 1 gives a multi-process writer.
+        The writer waits up to timeout seconds for the index lock.
+        """
+        if self.searcher is not None:
+            self.searcher.close()
+            self.searcher = None
+        self.ix = open_dir(self.database_dir)
+        self.writer = self.ix.writer(limitmb=self.limitmb, procs=self.procs,
+                                     timeout=self.timeout)
+        self.updated = {}  # file path: document updated by this writer
+        # ('file_path' or 'gid', value) of documents added, updated or
+        # deleted by this writer
+        self.changed = set()
+
+    def commit(self):
+        """Commit the writer, then delete texts of the documents deleted
+        by it from the ContentStore, which searches read until then.
+        """
+        self.writer.commit()
+        for gid in self.deleted_gids:
+            self.content_store.delete(gid)
+        self.deleted_gids = set()
 
     def close(self):
+        if self.searcher is not None:
+            self.searcher.close()
+            self.searcher = None
         del self.writer
         self.ix.close()
 
-    def create_index(self, ngram_min=1, ngram_max=2):
-        ngram_tokenizer = NgramTokenizer(minsize=ngram_min, maxsize=ngram_max)
+    @staticmethod
+    def create_index(database_dir=None):
+        Config.create_dirs()
+        if database_dir is None:
+            database_dir = Config.database_dir
+        os.makedirs(database_dir, exist_ok=True)
+        analyzer = metadata_analyzer()
         schema = Schema(file_path        = ID(stored=True, unique=True),  # primary key
                         gid              = ID(stored=True),  # document group id (pdf + texts)
                         parent_file_path = ID(stored=True),
-                        title            = TEXT(stored=True, sortable=True, analyzer=ngram_tokenizer),
-                        authors          = TEXT(stored=True, sortable=True, analyzer=ngram_tokenizer),
-                        publisher        = TEXT(stored=True, sortable=True, analyzer=ngram_tokenizer),
+                        title            = TEXT(stored=True, sortable=True, analyzer=analyzer),
+                        authors          = TEXT(stored=True, sortable=True, analyzer=analyzer),
+                        publisher        = TEXT(stored=True, sortable=True, analyzer=analyzer),
                         page             = NUMERIC(stored=True),
                         total_pages      = NUMERIC(stored=True),
                         tags             = KEYWORD(stored=True, lowercase=True, scorable=True),
-                        summary          = TEXT(stored=True, sortable=True, analyzer=ngram_tokenizer),
-                        memo             = TEXT(stored=True, sortable=True, analyzer=ngram_tokenizer),
+                        summary          = TEXT(stored=True, sortable=True, analyzer=analyzer),
+                        memo             = TEXT(stored=True, sortable=True, analyzer=analyzer),
                         language         = ID(stored=True),
                         document_format  = ID(stored=True),
                         identifier       = ID(stored=True),
                         series_id        = ID(stored=True),
                         published_at     = DATETIME(stored=True, sortable=True),
-                        created_at       = DATETIME(stored=True, sortable=True))
-
-        ix = create_in(Config.database_dir, schema)
-        Config.logger.info('Created db: ' + Config.database_dir)
+                        created_at       = DATETIME(stored=True, sortable=True),
+                        **upgrade_fields())
+
+        # Pre-declared content fields, so that indexing never changes schema
+        langs = Config.get().get('content_languages', [])
+        if langs == 'all':
+            langs = supported_languages()
+        for lang in langs:
+            schema.add('content_' + lang, content_field(lang))
+
+        ix = create_in(database_dir, schema)
+        Config.logger.info('Created db: ' + database_dir)
         ix.close()
 
     def _delete_files(self, docs):
+        """Delete files of documents. Only files in Config.pdf_dir and
+        Config.txt_dir are deleted, never files indexed from elsewhere.
+        """
         txt_dirs = []
         for doc in docs:
             fp = doc['file_path']
+            if not is_in_dir(fp, Config.pdf_dir) and \
+                    not is_in_dir(fp, Config.txt_dir):
+                Config.logger.warning('Not deleted, out of data dirs: ' + fp)
+                continue
             if fp.endswith('.txt'):
                 txt_dirs.append(os.path.dirname(fp))
             if os.path.exists(fp):
                 os.remove(fp)
 
         # remove empty directories
-        for td in txt_dirs:
-            if os.path.exists(td):
+        for td in dict.fromkeys(txt_dirs):
+            if os.path.exists(td) and os.listdir(td) == [] and \
+                    not os.path.samefile(td, Config.txt_dir):
                 os.rmdir(td)
 
     def delete_by_title(self, title, is_keep_file=False):
-        docs = self.get_documents('title', title)
+        docs = self.get_documents_by_title(title)
         if docs == []:
             raise ValueError('Not found: ' + title)
 
-        for doc in docs:
-            self.delete_document(doc['gid'], is_keep_file)
+        # pdf and its pages share the gid
+        for gid in dict.fromkeys(doc['gid'] for doc in docs):
+            self.delete_document(gid, is_keep_file)
         return
 
     def delete_by_field(self, field, value, is_keep_file=False):
@@ -90,13 +368,43 @@ class IndexManager:
         if not is_keep_file:
             self._delete_files(docs)
 
+        for doc in docs:
+            if doc['document_format'] == 'pdf':
+                self.pdf_changes[doc['gid']] = None
+            self._mark_changed(doc)
         n_doc = self.writer.delete_by_term(field, value)
         message = str(n_doc) + ' documents deleted.'
         Config.logger.info(message)
         return message
 
+    def delete_page(self, text_file_path):
+        """Delete the page of a text file, e.g. no longer in its document
+        group. Its file and text are kept."""
+        self.writer.delete_by_term('file_path', text_file_path)
+        self.changed.add(('file_path', text_file_path))
+
     def delete_document(self, gid, is_keep_file=False):
-        return self.delete_by_field('gid', gid, is_keep_file=is_keep_file)
+        message = self.delete_by_field('gid', gid, is_keep_file=is_keep_file)
+        if message is not None:
+            self.deleted_gids.add(gid)  # by commit()
+        return message
+
+    def delete_documents(self, gids, is_keep_file=False):
+        """Delete documents of gids, return a result per gid."""
+        results = []
+        for gid in OrderedDict.fromkeys(gids):
+            try:
+                message = self.delete_document(gid, is_keep_file)
+                if message is None:
+                    results.append({'key': gid, 'status': 'not found'})
+                else:
+                    results.append({'key': gid, 'status': 'deleted',
+                                    'message': message})
+            except Exception as err:
+                Config.logger.exception('Could not delete %s: %s', gid, err)
+                results.append({'key': gid, 'status': 'error',
+                                'message': str(err)})
+        return results
 
     def secure_datetime(self, date):
         """Normalize type-unknown date object."""
@@ -108,6 +416,7 @@ class IndexManager:
             day = date.day
             pdatetime = datetime.datetime(year, month, day)
         elif type(date) is str:
+            from dateutil.parser import parse
             pdatetime = parse(date)
         else:
             raise TypeError
@@ -115,8 +424,8 @@ class IndexManager:
         return pdatetime
 
     def add_pdf_file(self, file_path, gid=None, summary="", published_date=None):
-        if not os.path.exists(Config.database_dir):
-            raise ValueError('DB dir does not exist: ' + Config.database_dir)
+        if not os.path.exists(self.database_dir):
+            raise ValueError('DB dir does not exist: ' + self.database_dir)
 
         # set initial title: filename without ext
         title = os.path.splitext(os.path.basename(file_path))[0]
@@ -133,11 +442,13 @@ class IndexManager:
         if published_date is not None:
             pdatetime = self.secure_datetime(published_date)
             fields['published_at'] = pdatetime
-        self.writer.update_document(**fields)
+        self.writer.update_document(**with_sort_keys(fields))
+        self._mark_added(fields)
+        self.pdf_changes[gid] = fields
         Config.logger.info('Added :' + file_path)
 
     def add_summary(self, title, summary_text):
-        docs = self.get_documents('title', title)
+        docs = self.get_documents_by_title(title)
         if docs == []:
             raise ValueError('Document not found: ' + title)
 
@@ -154,60 +465,108 @@ class IndexManager:
         return
 
     def detect_lang(self, text):
-        try:
-            lang = langdetect.detect(text)
-            return lang
-        except:
-            return None
+        return detect_lang(text)
 
-    def add_lang_field(self, text, lang):
-        """Add language field if necessary."""
-        if lang is None:
-            return None
+    def add_fields(self, fields):
+        """Add new fields {name: field type} in one schema change.
 
-        content_field_name = 'content_' + lang
+        Whoosh cannot change the schema of a writer holding documents, so
+        call this before adding documents to keep one commit per batch;
+        otherwise the writer is committed and reopened first. A
+        multi-process writer is committed once more, because its
+        sub-writers read the schema from disk.
+        """
+        names = self.writer.schema.names()
+        new_names = sorted(name for name in fields if name not in names)
+        if new_names == []:
+            return new_names
 
-        # Add field to schema only in new language
-        if content_field_name not in self.ix.schema.names():
-            Config.logger.info('Add new content field: ' + content_field_name)
+        if has_added_documents(self.writer):
             self.writer.commit()
             self.open()
-            if lang == 'en':
-                self.writer.add_field(content_field_name,
-                                      TEXT(stored=True, sortable=True,
-                                           analyzer=StandardAnalyzer()))
-            elif lang in languages:
-                self.writer.add_field(content_field_name,
-                                      TEXT(stored=True, sortable=True,
-                                           analyzer=LanguageAnalyzer(lang)))
-            else:
-                ngram_tokenizer = NgramTokenizer(minsize=1, maxsize=2)
-                self.writer.add_field(content_field_name,
-                                      TEXT(stored=True, sortable=True,
-                                           analyzer=ngram_tokenizer))
+
+        for name in new_names:
+            Config.logger.info('Add new field: ' + name)
+            self.writer.add_field(name, fields[name])
+
+        if self.procs > 1:
             self.writer.commit()
             self.open()
 
-        return content_field_name
+        return new_names
+
+    def optimize(self):
+        """Merge all segments into one and purge deleted documents, then
+        compact the ContentStore. Pending changes are committed, and the
+        writer reopened.
+        """
+        before = index_stats(self.ix)
+        self.writer.commit(optimize=True)
+        self.open()
+        after = index_stats(self.ix)
+        n_bytes = self.compact_content()
+        Config.logger.info('Optimized index: {:d} -> {:d} segments, '
+                           '{:d} deleted documents purged, {:d} bytes of '
+                           'page texts removed'
+                           .format(before['segments'], after['segments'],
+                                   before['deleted_documents'], n_bytes))
+        return after
+
+    def compact_content(self):
+        """Remove texts of changed or deleted pages from the ContentStore
+        files of document groups, see ContentStore.compact(). Return the
+        number of bytes removed.
+        """
+        content_hashes = {}  # gid: content hashes of its pages
+        with self.ix.reader() as reader:
+            for _, stored in reader.iter_docs():
+                if stored.get('text_ref') is not None:
+                    content_hashes.setdefault(stored['gid'], set()).add(
+                            stored['content_hash'])
+        return sum(self.content_store.compact(gid, hashes)
+                   for gid, hashes in content_hashes.items())
+
+    def add_lang_fields(self, langs):
+        """Add content fields of new languages in one schema change."""
+        fields = {'content_' + lang: content_field(lang)
+                  for lang in langs if lang is not None}
+        return [name[len('content_'):] for name in self.add_fields(fields)]
+
+    def add_lang_field(self, text, lang):
+        """Add language field if necessary."""
+        if lang is None:
+            return None
+
+        self.add_lang_fields([lang])
+        return 'content_' + lang
 
     def add_text_file(self, text_file_path, gid=None, parent_file_path='', title='',
-                      num_page=1, published_date=None):
-        if not os.path.exists(Config.database_dir):
-            raise ValueError('DB dir does not exist: ' + Config.database_dir)
+                      num_page=1, published_date=None, prepared=None,
+                      mtime=None):
+        """prepared: (normalized text, language) from read_text_file(),
+        e.g. computed in a worker process. Read from file if None.
+        mtime: of the text source, e.g. the pdf of extracted pages; of the
+        text file if None.
+        """
+        if not os.path.exists(self.database_dir):
+            raise ValueError('DB dir does not exist: ' + self.database_dir)
 
         _, ext = os.path.splitext(text_file_path)
         if ext != '.txt':
             raise ValueError('Input file is not text file: ' + text_file_path)
 
-        with open(text_file_path, 'r', encoding='utf-8') as f:
-            content_text = f.read()
+        if prepared is None:
+            prepared = read_text_file(text_file_path)
+        content_text_normalized, lang = prepared
 
-        content_text_normalized = normalize(content_text)
+        if gid is None:
+            gid = str(uuid.uuid4())  # a group of its own
+        self.deleted_gids.discard(gid)  # added again
 
-        # detect language from text
-        lang = self.detect_lang(content_text_normalized)
         if lang is None:
             Config.logger.info('Could not detect language :' + text_file_path)
+        else:
+            self.langs.setdefault(gid, lang)
 
         # add lang field if necessary
         content_field_name = self.add_lang_field(content_text_normalized, lang)
@@ -228,28 +587,104 @@ class IndexManager:
         fields['page']             = num_page
         fields['document_format']  = 'txt'
         fields['created_at']       = datetime.datetime.now()
+        fields['content_hash']     = text_hash(content_text_normalized)
+        fields['mtime']            = mtime if mtime is not None \
+                                     else os.path.getmtime(text_file_path)
+        fields['text_ref'] = self.content_store.put(
+                gid, content_text_normalized, fields['content_hash'])
 
         if published_date is not None:
             pdatetime = self.secure_datetime(published_date)
             fields['published_at'] = pdatetime
-        self.writer.update_document(**fields)
+        self.writer.update_document(**with_sort_keys(fields))
+        self._mark_added(fields)
+        metrics.count('ingest_pages')
+        metrics.count('ingest_bytes',
+                      len(content_text_normalized.encode('utf-8')))
         Config.logger.info('Added :' + text_file_path)
 
-    def add_text_page_file(self, text_file_path, gid=None):
+    def _is_unchanged(self, text_file_path, doc):
+        """Whether a text file is unchanged since indexed as doc. If only
+        its mtime changed, it is kept for update_mtimes(), so that the file
+        is not read again next time.
+        """
+        mtime = os.path.getmtime(text_file_path)
+        if doc.get('mtime') == mtime:
+            return True
+        if doc.get('content_hash') is None:
+            return False
+        content_text, _ = read_text_file(text_file_path, detect=False)
+        if text_hash(content_text) != doc['content_hash']:
+            return False
+        self.mtime_updates[text_file_path] = mtime
+        return True
+
+    def update_mtimes(self):
+        """Store mtimes of text files found unchanged by get_changes().
+        Called after new content fields are added, since updated documents
+        would make add_fields() commit.
+        """
+        for text_file_path, mtime in self.mtime_updates.items():
+            self.update_field('file_path', text_file_path, 'mtime', mtime)
+        self.mtime_updates = {}
+
+    def get_pdf_pages(self, pdf_file_path):
+        """gid of an indexed pdf document (None if not indexed), and
+        stored fields of its pages {text file path: fields}.
+        """
+        pdfs = [doc for doc in self.get_documents('file_path', pdf_file_path)
+                if doc['document_format'] == 'pdf']
+        if pdfs == []:
+            return None, {}
+
+        gid = pdfs[0]['gid']
+        pages = {}
+        for doc in self.get_documents('gid', gid):
+            if doc['document_format'] == 'txt':
+                pages[doc['file_path']] = doc
+                if doc.get('language') is not None:
+                    self.langs.setdefault(gid, doc['language'])
+        return gid, pages
+
+    def get_changes(self, pdf_file_path, text_file_paths):
+        """Compare a document group with the index. Return gid of the indexed
+        document (None if new), text files new or changed since indexed,
+        and indexed text files removed. A text file is unchanged if its
+        mtime, or else its content hash, is the same; in the latter case
+        its mtime is stored by update_mtimes().
+
+        Indexed text files are removed if no longer on disk, and the group
+        has text files: pages extracted by --add-pdfs without --write-text
+        have no text files, and are kept.
+        """
+        gid, indexed = self.get_pdf_pages(pdf_file_path)
+        if gid is None:
+            return None, list(text_file_paths), []
+
+        changed = []
+        for tf in text_file_paths:
+            doc = indexed.pop(tf, None)
+            if doc is None or not self._is_unchanged(tf, doc):
+                changed.append(tf)
+        if text_file_paths == []:
+            return gid, changed, []
+        return gid, changed, sorted(tf for tf in indexed
+                                    if not os.path.exists(tf))
+
+    def add_text_page_file(self, text_file_path, gid=None, prepared=None):
         """Add database page-wise text file.
         filename format: {DOCUMENT_NAME}_p{NUM_PAGE}.txt
         """
         if not os.path.exists(text_file_path):
             raise ValueError('File does not exist: ' + text_file_path)
 
-        filename = os.path.basename(text_file_path)
-        m = re.search(r'(.+)_p(\d+).txt', filename)
-        if m is None:
+        name_page = split_page_file_name(os.path.basename(text_file_path))
+        if name_page is None:
             raise ValueError('Invalid file format: ' + text_file_path)
 
-        doc_filename = m.group(1) + '.pdf'
+        doc_filename = name_page[0] + '.pdf'
         doc_file_path = os.path.join(Config.pdf_dir, doc_filename)
-        num_page = int(m.group(2))
+        num_page = name_page[1]
 
         if not os.path.exists(doc_file_path):
             raise ValueError('Document file does not exist: ' + doc_file_path)
@@ -257,7 +692,8 @@ class IndexManager:
         self.add_text_file(text_file_path=text_file_path,
                            gid=gid,
                            parent_file_path=doc_file_path,
-                           num_page=num_page)
+                           num_page=num_page,
+                           prepared=prepared)
 
     def _result_to_dic(self, result):
         res_dic = {}
@@ -265,47 +701,179 @@ class IndexManager:
             res_dic[r] = result[r]
         return res_dic
 
+    def get_searcher(self):
+        """Searcher of the index opened with the writer, kept for lookups
+        until the writer is reopened.
+        """
+        if self.searcher is None:
+            self.searcher = self.ix.searcher()
+        return self.searcher
+
     def get_documents(self, search_field, query_str):
-        query = QueryParser(search_field, self.ix.schema).parse(query_str)
-        with self.ix.searcher() as searcher:
-            results = searcher.search(query, limit=100000)
-            res = [self._result_to_dic(r) for r in results]
-        return res
+        """Stored fields of documents matching query_str in search_field.
+        Values of ID fields, e.g. file_path and gid, are looked up as
+        exact terms, not parsed. Changes of this writer are committed
+        first if they touch the documents, see _commit_changed().
+        """
+        docs = self._search_documents(search_field, query_str)
+        if self._commit_changed(docs, (search_field, query_str)):
+            docs = self._search_documents(search_field, query_str)
+        return docs
+
+    def _search_documents(self, search_field, query_str):
+        searcher = self.get_searcher()
+        if isinstance(self.writer.schema[search_field], ID):
+            numbers = searcher.document_numbers(**{search_field: query_str})
+            return [searcher.stored_fields(n) for n in numbers]
+
+        query = QueryParser(search_field, self.writer.schema).parse(query_str)
+        results = searcher.search(query, limit=100000)
+        return [self._result_to_dic(r) for r in results]
+
+    def _mark_changed(self, doc):
+        self.changed.add(('file_path', doc['file_path']))
+        if doc.get('gid') is not None:
+            self.changed.add(('gid', doc['gid']))
+
+    def _mark_added(self, fields):
+        """Record a document added by the writer. Its earlier updates
+        are replaced by it."""
+        self._mark_changed(fields)
+        self.updated.pop(fields['file_path'], None)
+
+    def _commit_changed(self, docs, key):
+        """Commit and reopen the writer if the file path of any of docs,
+        looked up in the searcher by key (field, value), or the key itself,
+        was added, updated or deleted by the writer since: the searcher
+        does not see such changes, and the writer cannot delete documents
+        it added. Lookups by gid thus see pages of the gid added since,
+        while updates of other pages of a gid do not commit. Return True if
+        committed.
+        """
+        keys = {key}
+        keys.update(('file_path', doc['file_path']) for doc in docs)
+        if self.changed.isdisjoint(keys):
+            return False
+        self.writer.commit()
+        self.open()
+        return True
+
+    def _get_unique_document(self, unique_field_name, unique_field_value):
+        """Stored fields of the document, including updates made by this
+        writer but not committed yet.
+        """
+        if unique_field_name == 'file_path' and \
+                unique_field_value in self.updated:
+            return dict(self.updated[unique_field_value])
+
+        res = self.get_documents(unique_field_name, unique_field_value)
+        if len(res) != 1:
+            raise ValueError('{:d} documents found: {:s} {:s}'.format(
+                len(res), unique_field_name, str(unique_field_value)))
+        return res[0]
+
+    def get_keys(self, key_field_name, field, value):
+        """Values of key_field_name, without duplicates, of documents whose
+        field is exactly value. Analyzed fields, e.g. title, match by
+        shared n-grams, so that their documents are filtered by the stored
+        value, as get_documents_by_title() does.
+        """
+        docs = [doc for doc in self.get_documents(field, value)
+                if doc.get(field) == value]
+        keys = [doc.get(key_field_name) for doc in docs]
+        return [key for key in OrderedDict.fromkeys(keys) if key is not None]
+
+    def get_documents_by_title(self, title):
+        """Documents of exactly the title. Title is n-gram analyzed, so that
+        the query also matches titles sharing the n-grams.
+        """
+        return [doc for doc in self.get_documents('title', title)
+                if doc['title'] == title]
 
     def update_field(self, unique_field_name, unique_field_value,
                      update_field_name, update_field_value):
-        query = QueryParser(unique_field_name, self.ix.schema).parse(unique_field_value)
-        with self.ix.searcher() as searcher:
-            results = searcher.search(query)
-            res = [self._result_to_dic(r) for r in results]
-        assert len(res) == 1
-        res[0][update_field_name] = update_field_value
-        self.writer.update_document(**res[0])
-
-        # Avoid duplicates
-        if update_field_name == unique_field_name:
-            self.writer.delete_by_term(unique_field_name, unique_field_value)
+        self.update_fields(unique_field_name, unique_field_value,
+                           **{update_field_name: update_field_value})
 
     def update_fields(self, unique_field_name, unique_field_value,
                       **update_fields):
-        query = QueryParser(unique_field_name, self.ix.schema).\
-                parse(unique_field_value)
-        with self.ix.searcher() as searcher:
-            results = searcher.search(query)
-            res = [self._result_to_dic(r) for r in results]
-        assert len(res) == 1
-
+        doc = self._get_unique_document(unique_field_name, unique_field_value)
+        file_path = doc['file_path']
+        if doc.get('document_format') == 'txt':
+            # content is not stored in the index, index it again
+            content = self.content_store.page_text(doc)
+            if content is not None:
+                doc['content_' + doc['language']] = content
         for key in update_fields:
-            res[0][key] = update_fields[key]
-        self.writer.update_document(**res[0])
+            doc[key] = update_fields[key]
+        self.writer.update_document(**with_sort_keys(doc))
+        if doc.get('document_format') == 'pdf':
+            self.pdf_changes[doc['gid']] = doc
 
         # Avoid duplicates
         if unique_field_name in update_fields.keys():
             self.writer.delete_by_term(unique_field_name, unique_field_value)
+            self.changed.add((unique_field_name, unique_field_value))
+        self.updated.pop(file_path, None)
+        self.updated[doc['file_path']] = doc
+        self._mark_changed(doc)
+
+    def update_documents(self, unique_field_name, unique_field_values,
+                         **update_fields):
+        """Update fields of documents of unique_field_values, return
+        a result per document.
+        """
+        results = []
+        for value in OrderedDict.fromkeys(unique_field_values):
+            try:
+                self.update_fields(unique_field_name, value, **update_fields)
+                results.append({'key': value, 'status': 'updated'})
+            except Exception as err:
+                Config.logger.exception('Could not update %s: %s', value, err)
+                results.append({'key': value, 'status': 'error',
+                                'message': str(err)})
+        return results
 
     def get_all_documents(self):
-        query = Every()
+        """Stored fields of all documents. Use export_fields() on
+        reader.iter_docs() to go through a large index.
+        """
         with self.ix.searcher() as searcher:
-            results = searcher.search(query, limit=100000)
-            res = [self._result_to_dic(r) for r in results]
-        return res
+            return [dict(stored)
+                    for _, stored in searcher.reader().iter_docs()]
+
+    def import_documents(self, docs, add=False):
+        """Add documents of export_fields(), e.g. a chunk of an export.
+        Documents of the same file_path are replaced, unless add is True,
+        e.g. for an empty index. Page texts are indexed without language
+        detection, and put to the ContentStore.
+        """
+        self.add_lang_fields({doc.get('language') for doc in docs})
+        schema = self.writer.schema
+        for doc in docs:
+            fields = {}
+            for name, value in doc.items():
+                if name not in schema.names() or value is None:
+                    continue
+                if isinstance(schema[name], DATETIME):
+                    value = self.secure_datetime(value)
+                fields[name] = value
+
+            content = doc.get('content')
+            if content is not None:
+                fields['content_hash'] = text_hash(content)
+                if fields.get('language') is not None:
+                    fields['content_' + fields['language']] = content
+                if fields.get('gid') is not None:
+                    self.deleted_gids.discard(fields['gid'])
+                    fields['text_ref'] = self.content_store.put(
+                            fields['gid'], content, fields['content_hash'])
+
+            if add:
+                self.writer.add_document(**with_sort_keys(fields))
+            else:
+                self.writer.update_document(**with_sort_keys(fields))
+            if fields.get('file_path') is not None:
+                self._mark_added(fields)
+            if fields.get('document_format') == 'pdf':
+                self.pdf_changes[fields['gid']] = fields
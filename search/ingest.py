@@ -0,0 +1,273 @@
+from config import Config
+from helper import normalize
+from index_manager import detect_group_lang, detect_lang, read_text_file
+
+import collections
+import filecmp
+import functools
+import json
+import os
+import shutil
+import uuid
+
+
+def read_groups(file_groups, pool=None, window=4, langs=None):
+    """Yield (group, pages), pages being read_text_file() results of
+    the group's text files. With a process pool, up to window groups
+    ahead are read in parallel while the current group is being indexed.
+    langs: {text file: language} of pre-scanned files, not detected again.
+    """
+    if langs is None:
+        read = read_text_file
+    else:
+        read = functools.partial(read_text_file, detect=False)
+
+    def with_langs(group, pages):
+        if langs is not None:
+            pages = [(text, langs[tf]) for tf, (text, _)
+                     in zip(group['text_files'], pages)]
+        return group, pages
+
+    if pool is None:
+        for group in file_groups:
+            yield with_langs(group, [read(tf) for tf in group['text_files']])
+        return
+
+    groups = iter(file_groups)
+    pending = collections.deque()
+
+    def submit():
+        group = next(groups, None)
+        if group is not None:
+            pending.append(
+                (group, pool.map_async(read, group['text_files'])))
+
+    for _ in range(window):
+        submit()
+
+    while pending:
+        group, result = pending.popleft()
+        submit()
+        yield with_langs(group, result.get())
+
+
+def add_groups(im, file_groups, pool=None, progress=None, lang=None):
+    """Add document groups through IndexManager im, without commit.
+
+    With a process pool, text files are read, normalized and language
+    detected in the pool, and im is expected to have a multi-process
+    writer. progress(n_done, n_groups, n_pages) is called after each
+    group, n_pages being the number of pages indexed for it.
+
+    Language is detected once per document group, or given by lang
+    to skip detection.
+
+    Documents already indexed keep their gid and fields; only their new
+    or changed text files are indexed, and removed ones deleted.
+    """
+    for group in file_groups:
+        gid, changed, deleted = im.get_changes(group['pdf_file'],
+                                               group['text_files'])
+        group['is_indexed'] = gid is not None
+        if gid is not None:
+            group['id'] = gid
+        Config.logger.info('{:s}: {:d} of {:d} pages changed, {:d} deleted'
+                           .format(group['pdf_file'], len(changed),
+                                   len(group['text_files']), len(deleted)))
+        group['text_files'] = changed
+        for fp in deleted:
+            im.delete_page(fp)
+
+    # Pre-scan languages of groups not known to im, and add all new
+    # content fields at once before indexing starts
+    if lang is None:
+        new_groups = [group for group in file_groups
+                      if group['id'] not in im.langs
+                      and group['text_files'] != []]
+        text_files = [group['text_files'] for group in new_groups]
+        if pool is None:
+            detected = map(detect_group_lang, text_files)
+        else:
+            detected = pool.map(detect_group_lang, text_files)
+        for group, group_lang in zip(new_groups, detected):
+            im.langs[group['id']] = group_lang
+
+    langs = {}
+    for group in file_groups:
+        group_lang = lang if lang is not None else im.langs.get(group['id'])
+        for tf in group['text_files']:
+            langs[tf] = group_lang
+    im.add_lang_fields(set(langs.values()))
+    im.update_mtimes()
+
+    num_g = len(file_groups)
+    groups = read_groups(file_groups, pool, window=im.procs * 2, langs=langs)
+    for i, (group, pages) in enumerate(groups):
+        Config.logger.debug('Add document group: ' + str(group))
+        gid = group['id']
+        if not group['is_indexed']:
+            im.add_pdf_file(group['pdf_file'], gid)
+        for tf, page in zip(group['text_files'], pages):
+            im.add_text_page_file(tf, gid, prepared=page)
+
+        if progress is not None:
+            progress(i + 1, num_g, len(group['text_files']))
+
+
+def pdf_sources_path():
+    return os.path.join(Config.data_dir, 'pdf_sources.json')
+
+
+def read_pdf_sources():
+    """{source pdf file path: name of its copy in Config.pdf_dir}"""
+    if not os.path.exists(pdf_sources_path()):
+        return {}
+    with open(pdf_sources_path(), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_pdf_sources(sources):
+    with open(pdf_sources_path(), 'w', encoding='utf-8') as f:
+        f.write(json.dumps(sources, indent=4, ensure_ascii=False))
+
+
+def copy_pdf_file(pdf_file_path):
+    """Copy a pdf file into Config.pdf_dir, and return the path of the copy,
+    which is indexed instead, so that deleting the document never deletes
+    the original. Files already in pdf_dir are not copied.
+
+    The copy keeps the file name, or is named {name}_{N}.pdf if a file of
+    another source is there. A modified file replaces its copy, keeping
+    its mtime, so that its pages are extracted again under the same gid,
+    see get_changed_pdfs().
+    """
+    pdf_dir = os.path.abspath(Config.pdf_dir)
+    pdf_file_path = os.path.abspath(pdf_file_path)
+    if os.path.dirname(pdf_file_path) == pdf_dir:
+        return pdf_file_path
+
+    sources = read_pdf_sources()
+    copied = sources.get(pdf_file_path)
+    if copied is not None:
+        dst = os.path.join(pdf_dir, copied)
+        if os.path.exists(dst) and \
+                filecmp.cmp(pdf_file_path, dst, shallow=False):
+            return dst
+        shutil.copy2(pdf_file_path, dst)  # keeps mtime
+        Config.logger.info('Copied to: ' + dst)
+        return dst
+
+    copies = set(sources.values())
+    name = os.path.splitext(os.path.basename(pdf_file_path))[0]
+    n = 1
+    while True:
+        suffix = '' if n == 1 else '_{:d}'.format(n)
+        dst = os.path.join(pdf_dir, name + suffix + '.pdf')
+        is_copied = os.path.exists(dst)
+        if not is_copied or (os.path.basename(dst) not in copies and
+                             filecmp.cmp(pdf_file_path, dst, shallow=False)):
+            if not is_copied:
+                shutil.copy2(pdf_file_path, dst)
+                Config.logger.info('Copied to: ' + dst)
+            sources[pdf_file_path] = os.path.basename(dst)
+            write_pdf_sources(sources)
+            return dst
+        n += 1
+
+
+def page_file_path(pdf_file_path, num_page):
+    """Text file path of a page: {txt_dir}/{name}/{name}_p{N}.txt. It is
+    the key of the page in the index, even if the file is not written.
+    """
+    name = os.path.splitext(os.path.basename(pdf_file_path))[0]
+    return os.path.join(os.path.abspath(Config.txt_dir), name,
+                        '{:s}_p{:d}.txt'.format(name, num_page))
+
+
+def get_changed_pdfs(im, pdf_files):
+    """pdf files new or modified since their pages were indexed."""
+    changed = []
+    for pdf_file in pdf_files:
+        gid, pages = im.get_pdf_pages(pdf_file)
+        mtime = os.path.getmtime(pdf_file)
+        if gid is None or pages == {} or \
+                any(doc.get('mtime') != mtime for doc in pages.values()):
+            changed.append(pdf_file)
+    return changed
+
+
+def add_pdf_chunk(im, state, pdf_file, pages, lang=None, write_text=False):
+    """Add a chunk of pages of a pdf file through IndexManager im, without
+    commit. state: dict of the pdf kept between its chunks, empty for the
+    first one, which adds the pdf file. Chunks of a pdf may be added by
+    different IndexManagers, e.g. by mutations of a WriterService.
+    See add_pdfs() for lang and write_text.
+    """
+    if state == {}:
+        gid, indexed = im.get_pdf_pages(pdf_file)
+        if gid is None:
+            gid = str(uuid.uuid4())
+            im.add_pdf_file(pdf_file, gid)
+        page_lang = lang
+        if page_lang is None:
+            page_lang = detect_lang(' '.join(text for _, text in pages))
+        im.add_lang_fields([page_lang])
+        state.update(gid=gid, lang=page_lang, stale=set(indexed), n_pages=0)
+
+    pdf_mtime = os.path.getmtime(pdf_file)
+    for num_page, text in pages:
+        text_file = page_file_path(pdf_file, num_page)
+        state['stale'].discard(text_file)
+        if write_text:
+            os.makedirs(os.path.dirname(text_file), exist_ok=True)
+            with open(text_file, 'w', encoding='utf-8') as f:
+                f.write(text)
+        im.add_text_file(text_file, state['gid'], parent_file_path=pdf_file,
+                         num_page=num_page,
+                         prepared=(normalize(text), state['lang']),
+                         mtime=pdf_mtime)
+    state['n_pages'] += len(pages)
+
+
+def finish_pdf(im, state, pdf_file):
+    """Delete indexed pages of a pdf file not in its chunks, after the last
+    one is added by add_pdf_chunk(). Return the number of pages added.
+    """
+    for fp in state['stale']:
+        im.delete_page(fp)
+    Config.logger.info('{:s}: {:d} pages added, {:d} deleted'.format(
+        pdf_file, state['n_pages'], len(state['stale'])))
+    return state['n_pages']
+
+
+def add_pdfs(im, page_chunks, progress=None, lang=None, write_text=False):
+    """Add pdf files and their pages through IndexManager im as they are
+    extracted, without commit. page_chunks: (pdf file path, [(page number,
+    text), ...]) of extractor.iter_page_chunks(), in order of pages.
+
+    Page text files are written only with write_text. Pages keep the pdf
+    file's mtime either way, see get_changed_pdfs(). Language is detected
+    from the first chunk of each pdf, or given by lang.
+    progress(n_done, None, n_pages) is called after each pdf file.
+    """
+    n_done = 0
+    current = None  # pdf file path
+    state = {}
+
+    def finish():
+        n_pages = finish_pdf(im, state, current)
+        if progress is not None:
+            progress(n_done, None, n_pages)
+
+    for pdf_file, pages in page_chunks:
+        if pdf_file != current:
+            if current is not None:
+                n_done += 1
+                finish()
+            current, state = pdf_file, {}
+        add_pdf_chunk(im, state, pdf_file, pages, lang, write_text)
+
+    if current is not None:
+        n_done += 1
+        finish()
+    return n_done
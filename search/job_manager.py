@@ -0,0 +1,216 @@
+from config import Config
+from helper import separate_files
+from ingest import add_groups, add_pdf_chunk, copy_pdf_file, finish_pdf, \
+    get_changed_pdfs
+import extractor
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import threading
+import time
+import uuid
+
+
+class Job:
+    """Ingestion of a list of pdf/txt files, with its progress in memory.
+    With extract, files are pdf files to extract texts from, and groups
+    are pdf files. version is incremented on every change, for long
+    polling.
+    """
+    def __init__(self, files, lang=None, extract=False, write_text=False):
+        self.id = str(uuid.uuid4())
+        self.files = files
+        self.lang = lang
+        self.extract = extract
+        self.write_text = write_text
+        self.status = 'queued'  # running, finished, failed or cancelled
+        self.error = None
+        self.n_groups = 0
+        self.n_done_groups = 0
+        self.n_pages = 0  # pages indexed, excluding unchanged ones
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.version = 0
+
+    def is_done(self):
+        return self.status in ['finished', 'failed', 'cancelled']
+
+    def to_dict(self):
+        elapsed = 0.0
+        if self.started_at is not None:
+            end = self.finished_at if self.is_done() else time.time()
+            elapsed = end - self.started_at
+
+        eta = None
+        if self.status == 'running' and self.n_done_groups > 0:
+            eta = elapsed / self.n_done_groups * \
+                    (self.n_groups - self.n_done_groups)
+
+        return {'id': self.id,
+                'status': self.status,
+                'error': self.error,
+                'n_groups': self.n_groups,
+                'n_done_groups': self.n_done_groups,
+                'n_pages': self.n_pages,
+                'progress': self.n_done_groups / self.n_groups
+                            if self.n_groups > 0 else 0.0,
+                'elapsed': elapsed,
+                'pages_per_second': self.n_pages / elapsed
+                                    if elapsed > 0 else 0.0,
+                'eta': eta,
+                'version': self.version}
+
+
+class JobManager:
+    """Run ingestion jobs one at a time in a background thread.
+
+    Document groups are indexed through a WriterService, batch_size groups
+    per mutation, so that API updates are applied between batches.
+    Texts are extracted in a pool of procs processes. At most max_jobs
+    finished jobs are kept.
+    """
+    def __init__(self, writer, batch_size=100, max_jobs=100, procs=1):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.procs = procs
+        self.max_jobs = max_jobs
+        self.jobs = OrderedDict()  # id: Job
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.is_stopped = False
+
+    def submit(self, files, lang=None, extract=False, write_text=False):
+        job = Job(files, lang, extract, write_text)
+        with self.condition:
+            self.jobs[job.id] = job
+            self.trim()
+        self.executor.submit(self.run, job)
+        return job
+
+    def get(self, job_id):
+        with self.condition:
+            return self.jobs.get(job_id)
+
+    def list(self):
+        with self.condition:
+            return list(self.jobs.values())
+
+    def wait(self, job_id, since=-1, timeout=0.0):
+        """Wait up to timeout seconds for job job_id to change from version
+        since. Return the job, or None if not found.
+        """
+        with self.condition:
+            self.condition.wait_for(
+                lambda: job_id not in self.jobs or
+                self.jobs[job_id].version > since, timeout)
+            return self.jobs.get(job_id)
+
+    def update(self, job, **attrs):
+        with self.condition:
+            for name, value in attrs.items():
+                setattr(job, name, value)
+            job.version += 1
+            self.condition.notify_all()
+
+    def trim(self):
+        done = [job_id for job_id, job in self.jobs.items() if job.is_done()]
+        for job_id in done[:max(0, len(done) - self.max_jobs)]:
+            del self.jobs[job_id]
+
+    def stop(self):
+        """Cancel queued jobs and stop the running one after its batch."""
+        self.is_stopped = True
+        self.executor.shutdown(wait=True)
+
+    def add_groups(self, job):
+        """Add document groups of pdf/txt files. Return False if cancelled.
+        """
+        file_groups = separate_files(job.files)
+        if file_groups == []:
+            raise ValueError('Empty document group: ' + str(job.files))
+        self.update(job, n_groups=len(file_groups))
+
+        for start in range(0, len(file_groups), self.batch_size):
+            if self.is_stopped:
+                return False
+
+            def progress(n_done, n_groups, n_pages):
+                self.update(job, n_done_groups=start + n_done,
+                            n_pages=job.n_pages + n_pages)
+
+            batch = file_groups[start:start + self.batch_size]
+            self.writer.submit(add_groups, batch, None, progress,
+                               job.lang).result()
+        return True
+
+    def add_pdfs(self, job):
+        """Extract texts of pdf files in a process pool, and add them one
+        chunk of pages per mutation, while the next chunk is being
+        extracted. Files are copied into Config.pdf_dir first. Return False
+        if cancelled.
+        """
+        pdf_files = [copy_pdf_file(f) for f in job.files]
+        pdf_files = self.writer.submit(get_changed_pdfs, pdf_files).result()
+        self.update(job, n_groups=len(pdf_files))
+
+        pool = None
+        if self.procs > 1:
+            pool = multiprocessing.Pool(self.procs)
+        try:
+            current = None  # pdf file path
+            state = {}
+            pending = None  # mutation of the last chunk, and its pages
+            for pdf_file, pages in extractor.iter_page_chunks(pdf_files,
+                                                              pool):
+                if pending is not None:
+                    pending[0].result()
+                    self.update(job, n_pages=job.n_pages + pending[1])
+                if pdf_file != current:
+                    if current is not None:
+                        self.writer.submit(finish_pdf, state,
+                                           current).result()
+                        self.update(job, n_done_groups=job.n_done_groups + 1)
+                    if self.is_stopped:
+                        return False
+                    current, state = pdf_file, {}
+                pending = (self.writer.submit(add_pdf_chunk, state, pdf_file,
+                                              pages, job.lang,
+                                              job.write_text), len(pages))
+            if pending is not None:
+                pending[0].result()
+                self.update(job, n_pages=job.n_pages + pending[1])
+            if current is not None:
+                self.writer.submit(finish_pdf, state, current).result()
+                self.update(job, n_done_groups=job.n_done_groups + 1)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        return True
+
+    def run(self, job):
+        if self.is_stopped:
+            self.update(job, status='cancelled', finished_at=time.time())
+            return
+
+        self.update(job, status='running', started_at=time.time())
+        try:
+            if job.extract:
+                is_done = self.add_pdfs(job)
+            else:
+                is_done = self.add_groups(job)
+        except Exception as err:
+            Config.logger.exception('Error in job %s: %s', job.id, err)
+            self.update(job, status='failed', error=str(err),
+                        finished_at=time.time())
+            return
+
+        if not is_done:
+            self.update(job, status='cancelled', finished_at=time.time())
+            return
+
+        Config.logger.info('Job {:s}: added {:d} pages in {:d} groups'
+                           .format(job.id, job.n_pages, job.n_groups))
+        self.update(job, status='finished', finished_at=time.time())
@@ -0,0 +1,112 @@
+from collections import deque
+from contextlib import contextmanager
+
+import threading
+import time
+
+
+def _key_str(name, labels):
+    if labels == ():
+        return name
+    return name + '{' + ','.join('{:s}="{:s}"'.format(k, v)
+                                 for k, v in labels) + '}'
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p * (len(values) - 1))))]
+
+
+class Metrics:
+    """Counters and timings of this process.
+
+    Counters also give a rate per second over the last rate_window seconds.
+    Timings keep count, sum and max, and quantiles of the last window_size
+    observations.
+    """
+    def __init__(self, rate_window=60.0, window_size=1000):
+        self.rate_window = rate_window
+        self.window_size = window_size
+        self.lock = threading.Lock()
+        self.counters = {}  # key: [total, deque of [second, sum of values]]
+        self.timings = {}  # key: [count, sum, max, deque of seconds]
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.counters:
+                self.counters[key] = [0, deque(maxlen=int(self.rate_window))]
+            counter = self.counters[key]
+            counter[0] += value
+            second = int(time.time())
+            if counter[1] and counter[1][-1][0] == second:
+                counter[1][-1][1] += value
+            else:
+                counter[1].append([second, value])
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.timings:
+                self.timings[key] = [0, 0.0, 0.0,
+                                     deque(maxlen=self.window_size)]
+            timing = self.timings[key]
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+            timing[3].append(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def _rate(self, buckets, now):
+        recent = [v for t, v in buckets if t > now - self.rate_window]
+        return sum(recent) / self.rate_window
+
+    def to_dict(self):
+        now = time.time()
+        res = {'counters': {}, 'timings': {}}
+        with self.lock:
+            for key, (total, events) in self.counters.items():
+                res['counters'][_key_str(*key)] = {
+                    'total': total, 'rate_per_s': self._rate(events, now)}
+            for key, (n, total, maximum, recent) in self.timings.items():
+                res['timings'][_key_str(*key)] = {
+                    'count': n, 'sum_s': total, 'max_s': maximum,
+                    'p50_s': _percentile(recent, 0.5),
+                    'p99_s': _percentile(recent, 0.99)}
+        return res
+
+    def to_prometheus(self, prefix='mirusan_'):
+        """Prometheus text exposition format."""
+        now = time.time()
+        lines = []
+        with self.lock:
+            for (name, labels), (total, events) in sorted(
+                    self.counters.items()):
+                lines.append('{:s} {}'.format(
+                    _key_str(prefix + name + '_total', labels), total))
+                lines.append('{:s} {}'.format(
+                    _key_str(prefix + name + '_per_second', labels),
+                    self._rate(events, now)))
+            for (name, labels), (n, total, _, recent) in sorted(
+                    self.timings.items()):
+                name = prefix + name + '_seconds'
+                for q in [0.5, 0.99]:
+                    lines.append('{:s} {}'.format(
+                        _key_str(name, labels + (('quantile', str(q)),)),
+                        _percentile(recent, q)))
+                lines.append('{:s} {}'.format(
+                    _key_str(name + '_count', labels), n))
+                lines.append('{:s} {}'.format(
+                    _key_str(name + '_sum', labels), total))
+        return '\n'.join(lines) + '\n'
+
+
+# Registry of this process
+metrics = Metrics()
@@ -1,35 +1,90 @@
 from config import Config
-from helper import separate_files
-from index_manager import IndexManager
+from content_store import ContentStore
+from helper import iter_document_groups, separate_files
+from index_manager import IndexManager, analyzer_profiles, \
+    changed_analyzers, detect_lang, ensure_index, export_fields
+from ingest import add_groups, add_pdfs, copy_pdf_file, get_changed_pdfs
 from search_manager import Search
+import extractor
+
+from whoosh.index import exists_in, open_dir
 
 import argparse
-import langdetect
+import gzip
+import itertools
+import json
+import multiprocessing
 import os
+import shutil
+import time
+
+
+def add_pdf_files(pdf_files, procs=1, lang=None, write_text=False):
+    """Extract texts of pdf files in a pool of procs processes, and add
+    them page by page to the index. Files are copied into Config.pdf_dir,
+    and unchanged ones skipped.
+    """
+    Config.create_dirs()
+    pdf_files = [copy_pdf_file(pdf_file) for pdf_file in pdf_files]
+    im = IndexManager()
+    pdf_files = get_changed_pdfs(im, pdf_files)
+
+    def log_progress(n_done, n_groups, n_pages):
+        Config.logger.info('Added {:d} of {:d} pdf files'.format(
+            n_done, len(pdf_files)))
+
+    pool = None
+    if procs > 1:
+        pool = multiprocessing.Pool(procs)
+
+    try:
+        add_pdfs(im, extractor.iter_page_chunks(pdf_files, pool),
+                 log_progress, lang, write_text)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
+    im.writer.commit()
+    im.ix.close()
+    return len(pdf_files)
 
-def add_files(files):
+
+def add_files(files, procs=1, lang=None):
     """Using from electron, this argument consists of multiple pdf/txt file
     pairs, due to the restriction in JS code.
+
+    procs > 1 reads, normalizes and detects language of text files in
+    a process pool, and indexes them with a multi-process writer.
+    lang: language of the files, not detected if given.
     """
     file_groups = separate_files(files)
     if file_groups == []:
         raise ValueError('Empty document group: ' + str(files))
 
-    im = IndexManager()
-
-    num_g = len(file_groups)
-    for i, group in enumerate(file_groups):
-        Config.logger.debug('Add document group: ' + str(group))
-        gid = group['id']
-        im.add_pdf_file(group['pdf_file'], gid)
-        for tf in group['text_files']:
-            im.add_text_page_file(tf, gid)
+    percents = set()
 
-        # record progress, read from api server
-        progress = (i + 1) / num_g
+    def record_progress(n_done, n_groups, n_pages):
+        # read from api server, written once per percent
+        percent = n_done * 100 // n_groups
+        if percent in percents:
+            return
+        percents.add(percent)
         with open('progress_add_db', 'w') as f:
-            f.write(str(progress))
+            f.write(str(n_done / n_groups))
+
+    im = IndexManager(procs=procs)
+
+    pool = None
+    if procs > 1:
+        pool = multiprocessing.Pool(procs)
+
+    try:
+        add_groups(im, file_groups, pool, record_progress, lang)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     with open('progress_add_db', 'w') as f:
         f.write('Finished')
@@ -39,6 +94,78 @@ def add_files(files):
     return
 
 
+def add_group_batches(file_groups, procs=1, batch_size=100, lang=None,
+                      timeout=0.0):
+    """Add document groups from an iterable, committing every batch_size
+    groups, so that a large tree is never held in one batch. Each batch
+    waits up to timeout seconds for the index lock.
+    """
+    file_groups = iter(file_groups)
+
+    pool = None
+    if procs > 1:
+        pool = multiprocessing.Pool(procs)
+
+    n_added = 0
+    try:
+        while True:
+            batch = list(itertools.islice(file_groups, batch_size))
+            if batch == []:
+                break
+            im = IndexManager(procs=procs, timeout=timeout)
+            add_groups(im, batch, pool, lang=lang)
+            im.writer.commit()
+            im.ix.close()
+            n_added += len(batch)
+            Config.logger.info('Added {:d} document groups'.format(n_added))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return n_added
+
+
+def add_dir(procs=1, batch_size=100, lang=None):
+    """Add pdf files in Config.pdf_dir with their page-wise text files in
+    Config.txt_dir.
+    """
+    Config.create_dirs()
+    groups = iter_document_groups(Config.pdf_dir, Config.txt_dir)
+    return add_group_batches(groups, procs, batch_size, lang)
+
+
+def watch_dir(interval, procs=1, batch_size=100, lang=None):
+    """Add document groups in Config.pdf_dir and Config.txt_dir, then every
+    interval seconds those with new or modified files. Groups not added,
+    e.g. while the server holds the index lock, are tried again at the
+    next scan.
+    """
+    Config.create_dirs()
+    snapshot = {}  # pdf file: mtimes of group files
+    while True:
+        changed = []
+        new_snapshot = {}
+        for group in iter_document_groups(Config.pdf_dir, Config.txt_dir):
+            files = [group['pdf_file']] + group['text_files']
+            try:
+                state = [(f, os.path.getmtime(f)) for f in files]
+            except FileNotFoundError:
+                continue  # being removed, see at next scan
+            new_snapshot[group['pdf_file']] = state
+            if snapshot.get(group['pdf_file']) != state:
+                changed.append(group)
+        if changed != []:
+            try:
+                add_group_batches(changed, procs, batch_size, lang,
+                                  timeout=interval)
+            except Exception as err:
+                Config.logger.exception('Could not add groups: %s', err)
+                for group in changed:
+                    new_snapshot.pop(group['pdf_file'], None)
+        snapshot = new_snapshot
+        time.sleep(interval)
+
+
 def add_summary(title, summary_file):
     if not os.path.exists(summary_file):
         raise FileNotFoundError(summary_file)
@@ -56,27 +183,179 @@ def delete_by_title(title, is_keep_file=False):
     im = IndexManager()
     Config.logger.debug('Delete by title: ' + title)
     im.delete_by_title(title, is_keep_file)
-    im.writer.commit()
+    im.commit()
     im.ix.close()
     return
 
 
+def open_ndjson(path, mode='r'):
+    """Text file of newline-delimited JSON, gzip compressed if path ends
+    with .gz."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+def export_index(path):
+    """Write all documents to path, a document per line, with their page
+    texts. Documents are read one at a time from a searcher, without
+    locking the index.
+    """
+    ix = open_dir(Config.database_dir)
+    content_store = ContentStore()
+    n_docs = 0
+    with ix.searcher() as searcher, open_ndjson(path, 'w') as f:
+        for _, stored in searcher.reader().iter_docs():
+            doc = export_fields(stored, content_store)
+            f.write(json.dumps(doc, ensure_ascii=False) + '\n')
+            n_docs += 1
+    ix.close()
+    Config.logger.info('Exported {:d} documents to {:s}'.format(n_docs, path))
+    return n_docs
+
+
+def import_index(path, chunk_size=5000, database_dir=None):
+    """Add documents of an export, committing every chunk_size documents.
+    Documents already in the index are replaced. database_dir: of the
+    index, Config.database_dir if None.
+    """
+    im = IndexManager(database_dir=database_dir)
+    add = im.ix.doc_count_all() == 0  # nothing to replace
+    n_docs = 0
+    with open_ndjson(path) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if lines == []:
+                break
+            docs = [json.loads(line) for line in lines if line.strip() != '']
+            im.import_documents(docs, add=add)
+            im.writer.commit()
+            im.open()
+            im.pdf_changes = {}
+            n_docs += len(docs)
+            Config.logger.info('Imported {:d} documents'.format(n_docs))
+    im.writer.cancel()
+    im.close()
+    return n_docs
+
+
+def reindex():
+    """Create the index again with the current analyzer profiles, from an
+    export of its documents. The new index is built in another directory,
+    and replaces the old one only after all documents are imported, so
+    that a failed reindex leaves the old index as it was.
+    """
+    export_path = os.path.join(Config.data_dir, 'reindex.ndjson.gz')
+    new_dir = Config.database_dir + '.new'
+    old_dir = Config.database_dir + '.old'
+    n_docs = export_index(export_path)
+    if os.path.exists(new_dir):
+        shutil.rmtree(new_dir)  # of a failed reindex
+    import_index(export_path, database_dir=new_dir)
+
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+    os.rename(Config.database_dir, old_dir)
+    os.rename(new_dir, Config.database_dir)
+    shutil.rmtree(old_dir)
+    os.remove(export_path)
+    Config.logger.info('Reindexed {:d} documents'.format(n_docs))
+    return n_docs
+
+
+def check_analyzers():
+    """Reindex if fields of the index are analyzed otherwise than by the
+    analyzer profiles, e.g. after they are changed in config.json. Return
+    names of the changed fields.
+    """
+    if not exists_in(Config.database_dir):
+        return []
+    ix = open_dir(Config.database_dir)
+    changed = changed_analyzers(ix.schema)
+    ix.close()
+    if changed != []:
+        Config.logger.info('Analyzers changed: ' + ', '.join(changed))
+        reindex()
+    return changed
+
+
+def set_ngram_sizes(ngram_min=None, ngram_max=None):
+    """Set n-gram sizes of the n-gram analyzer profiles, and save them to
+    config.json, so that later runs, e.g. --server started by the electron
+    app, analyze by the same profiles and do not reindex again.
+    """
+    profiles = analyzer_profiles()
+    for name, profile in profiles.items():
+        if profile.get('analyzer') != 'ngram':
+            continue
+        profile = dict(profile)
+        if ngram_min is not None:
+            profile['ngram_min'] = ngram_min
+        if ngram_max is not None:
+            profile['ngram_max'] = ngram_max
+        profiles[name] = profile
+    if profiles != Config.get().get('analyzers'):
+        Config.get()['analyzers'] = profiles
+        Config.save()
+
+
+def optimize():
+    """Merge all segments of the index and purge deleted documents."""
+    im = IndexManager()
+    stats = im.optimize()
+    im.writer.cancel()  # reopened writer has nothing to commit
+    im.ix.close()
+    return stats
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', default='./config.json')
     parser.add_argument('--query', default='')
     parser.add_argument('--init', help='Initialize database',
                         action='store_true')
-    parser.add_argument('--add-dir', default=None)
+    parser.add_argument('--add-dir', action='store_true',
+                        help='Add files in pdf_dir and txt_dir')
+    parser.add_argument('--watch', default=None, type=float,
+                        help='With --add-dir, add new or modified files '
+                             'every WATCH seconds')
+    parser.add_argument('--batch-size', default=100, type=int,
+                        help='Document groups per commit for --add-dir')
     parser.add_argument('--add-files', default=None, nargs='+')
+    parser.add_argument('--procs', default=1, type=int,
+                        help='Number of worker processes for adding files')
+    parser.add_argument('--lang', default=None,
+                        help='Language of added files, e.g. en. '
+                             'Skips language detection')
+
+    parser.add_argument('--add-pdfs', default=None, nargs='+',
+                        help='Extract texts of pdf files and add them')
+    parser.add_argument('--write-text', action='store_true',
+                        help='With --add-pdfs, also write page text files')
 
     parser.add_argument('--add-summary', default=None, nargs='+')
 
     parser.add_argument('--delete-by-title', default=None)
     parser.add_argument('--keep-file', action='store_true')
-
-    parser.add_argument('--ngram-min', default=1)
-    parser.add_argument('--ngram-max', default=2)
+    parser.add_argument('--optimize', action='store_true',
+                        help='Merge index segments and purge deleted '
+                             'documents')
+
+    parser.add_argument('--export', default=None, metavar='PATH',
+                        help='Write all documents as newline-delimited '
+                             'JSON, gzip compressed if PATH ends with .gz')
+    parser.add_argument('--import', default=None, metavar='PATH',
+                        dest='import_path', help='Add documents of --export')
+    parser.add_argument('--chunk-size', default=5000, type=int,
+                        help='Documents per commit for --import')
+
+    parser.add_argument('--reindex', action='store_true',
+                        help='Create the index again with the analyzers')
+    parser.add_argument('--ngram-min', default=None, type=int,
+                        help='Set n-gram sizes of the analyzer profiles '
+                             'in config.json. The index is reindexed by '
+                             '--init or --server if they differ')
+    parser.add_argument('--ngram-max', default=None, type=int)
 
     parser.add_argument('--server', action='store_true')
     parser.add_argument('--stand-alone', action='store_true')
@@ -84,10 +363,12 @@ def main():
 
     args = parser.parse_args()
 
+    if args.ngram_min is not None or args.ngram_max is not None:
+        set_ngram_sizes(args.ngram_min, args.ngram_max)
+
     if args.server:
-        im = IndexManager()
-        im.close()
-        del im
+        check_analyzers()
+        ensure_index()
         import api_server
         server = api_server.Server()
         if args.stand_alone:
@@ -98,9 +379,15 @@ def main():
         return
 
     if args.init:
+        check_analyzers()
         im = IndexManager()
         return
 
+    if args.reindex:
+        print('reindex')
+        print(reindex())
+        return
+
     if args.query != '':
         print('search: ' + args.query)
         try:
@@ -121,12 +408,36 @@ def main():
             add_file_list = args.add_files
 
         try:
-            add_files(add_file_list)
+            add_files(add_file_list, procs=args.procs, lang=args.lang)
         except Exception as err:
             Config.logger.exception('Could not add files: %s', err)
             print(err)
         return
 
+    if args.add_pdfs is not None:
+        print('add pdfs: ' + str(args.add_pdfs))
+        try:
+            add_pdf_files(args.add_pdfs, procs=args.procs, lang=args.lang,
+                          write_text=args.write_text)
+        except Exception as err:
+            Config.logger.exception('Could not add pdfs: %s', err)
+            print(err)
+        return
+
+    if args.add_dir:
+        print('add dir: ' + Config.pdf_dir + ', ' + Config.txt_dir)
+        try:
+            if args.watch is None:
+                add_dir(procs=args.procs, batch_size=args.batch_size,
+                        lang=args.lang)
+            else:
+                watch_dir(args.watch, procs=args.procs,
+                          batch_size=args.batch_size, lang=args.lang)
+        except Exception as err:
+            Config.logger.exception('Could not add dir: %s', err)
+            print(err)
+        return
+
     if args.add_summary is not None:
         print('add summary: ' + str(args.add_summary))
         title = args.add_summary[0]
@@ -140,8 +451,27 @@ def main():
         delete_by_title(title, args.keep_file)
         return
 
+    if args.optimize:
+        print('optimize')
+        print(optimize())
+        return
+
+    if args.export is not None:
+        print('export: ' + args.export)
+        print(export_index(args.export))
+        return
+
+    if args.import_path is not None:
+        print('import: ' + args.import_path)
+        try:
+            print(import_index(args.import_path, args.chunk_size))
+        except Exception as err:
+            Config.logger.exception('Could not import: %s', err)
+            print(err)
+        return
+
     if args.lang_detect:
-        print(langdetect.detect(args.lang_detect))
+        print(detect_lang(args.lang_detect))
         return
 
     parser.print_help()
@@ -1,20 +1,99 @@
 from config import Config
+from content_store import ContentStore
+from helper import normalize
+from metrics import metrics
+from result_cache import ResultCache
+from sorted_index import SortedIndexCache
 
+from whoosh.fields import TEXT
+from whoosh.highlight import ContextFragmenter
 from whoosh.index import open_dir
 from whoosh.qparser import MultifieldParser
-from whoosh.query import Every, Term
-
+from whoosh.query import And, Or, Term
+from whoosh.sorting import FieldFacet, ScoreFacet
 
+from collections import OrderedDict
 import os
 import datetime
-import re
+import threading
+import time
+
+# Stored fields for indexing only, not in results
+INTERNAL_FIELDS = ['text_ref', 'content_hash', 'mtime']
 
 
 class Search:
     def __init__(self):
         if not os.path.exists(Config.database_dir):
             raise ValueError('DB dir does not exist: ' + Config.database_dir)
-        self.ix = open_dir(Config.database_dir)
+        self._ix = None  # opened on first search
+        self.lock = threading.Lock()
+        self.local = threading.local()  # searcher and parser per thread
+        self.searchers = []
+        config = Config.get()
+        self.cache = ResultCache(config.get('result_cache_size', 128))
+        # highlighting defaults: fragments per page, characters per
+        # fragment, and characters of a page scanned for fragments
+        self.max_fragments = config.get('highlight_max_fragments', 3)
+        self.fragment_size = config.get('highlight_fragment_size', 200)
+        self.highlight_charlimit = config.get('highlight_charlimit', 2 ** 15)
+        self.sorted_index = SortedIndexCache(self._to_dict)
+        self.content_store = ContentStore()
+
+    @property
+    def ix(self):
+        with self.lock:
+            if self._ix is None:
+                self._ix = open_dir(Config.database_dir)
+            return self._ix
+
+    @property
+    def parser(self):
+        return self.local.parser
+
+    @property
+    def search_fields(self):
+        return self.local.search_fields
+
+    def get_searcher(self):
+        """Return long-lived searcher of the current thread. It is refreshed,
+        the query parser rebuilt and cached results dropped, only when the
+        index generation changes after a commit.
+        """
+        searcher = getattr(self.local, 'searcher', None)
+        if searcher is None:
+            searcher = self.ix.searcher()
+            self.searchers.append(searcher)
+        elif not searcher.up_to_date():
+            self.searchers.remove(searcher)
+            searcher = searcher.refresh()
+            self.searchers.append(searcher)
+            self.cache.clear()
+            self.content_store.clear()
+        else:
+            return searcher
+
+        content_fields = []  # langauge-wise content fields
+        for name in searcher.schema.names():
+            if name.startswith('content_') and \
+                    isinstance(searcher.schema[name], TEXT):
+                content_fields.append(name)
+        self.local.searcher = searcher
+        self.local.search_fields = content_fields + ['title']
+        self.local.parser = MultifieldParser(self.local.search_fields,
+                                             searcher.schema)
+        return searcher
+
+    def close(self):
+        for searcher in self.searchers:
+            searcher.close()
+        self.searchers = []
+        self.local = threading.local()
+        self.content_store.clear()
+        with self.lock:
+            if self._ix is not None:
+                self._ix.close()
+                self._ix = None
 
     def _normalize_path(self, path):
         """Convert path separator for windows."""
@@ -22,20 +101,108 @@ class Search:
             path.replace('/', os.path.sep)
         return path
 
+    def _to_dict(self, stored, fields=None):
+        """Copy stored fields, all or only the given ones, to a dict,
+        without INTERNAL_FIELDS."""
+        d = {}
+        for key in stored.keys() if fields is None else fields:
+            if key not in stored or key in INTERNAL_FIELDS:
+                continue
+            if type(stored[key]) == datetime.datetime:
+                d[key] = stored[key].isoformat()
+            elif key == 'file_path':
+                d[key] = self._normalize_path(stored[key])
+            else:
+                d[key] = stored[key]
+        return d
+
+    def set_fragmenter(self, results, fragment_size=None):
+        """Fragments of fragment_size characters, from the first
+        highlight_charlimit characters of each page.
+        """
+        if fragment_size is None:
+            fragment_size = self.fragment_size
+        results.fragmenter = ContextFragmenter(
+                maxchars=fragment_size, surround=min(20, fragment_size // 2),
+                charlimit=self.highlight_charlimit)
+
+    def _highlights(self, hit, text, max_fragments=None):
+        if max_fragments is None:
+            max_fragments = self.max_fragments
+        content_field_name = 'content_' + hit['language']
+        # remove garbled characters
+        return self.remove_garble(
+                hit.highlights(content_field_name, text=text,
+                               top=max_fragments))
+
+    def _page_row(self, hit, fields=None, content_length=None,
+                  highlight=False, max_fragments=None):
+        """Result row of a page hit, and time spent for highlighting.
+        The page text is read from the content store only if needed.
+        """
+        stored = hit.fields()
+        d = self._to_dict(stored, fields)
+
+        text = None
+        if fields is None or 'content' in fields:
+            text = self.content_store.page_text(stored) or ''
+            d['content'] = text[:content_length]
+
+        highlight_time = 0.
+        if highlight:
+            start = time.perf_counter()
+            if text is None:
+                text = self.content_store.page_text(stored) or ''
+            d['highlighted_body'] = ''
+            if text != '':  # empty, or language unknown
+                d['highlighted_body'] = self._highlights(hit, text,
+                                                         max_fragments)
+            highlight_time = time.perf_counter() - start
+        return d, highlight_time
+
     def search(self, query_str, sort_field, reverse=False,
-               n_page=1, pagelen=10):
+               n_page=1, pagelen=10, fields=None, content_length=None,
+               group_pages=None, highlight=False, max_fragments=None,
+               fragment_size=None):
+        """fields: names of stored fields to return, and 'content'.
+        All of them if None.
+        content_length: number of characters of 'content' to return.
+        group_pages: if given, group hits by document, see search_grouped().
+        highlight: return 'highlighted_body' of up to max_fragments
+        fragments of fragment_size characters. Also enabled by
+        'highlighted_body' in fields.
+        """
         Config.logger.debug('Get query: ' + query_str)
+        if fields is not None:
+            fields = tuple(fields)
+            highlight = highlight or 'highlighted_body' in fields
+        highlight_options = (max_fragments, fragment_size) if highlight \
+            else None
 
-        content_fields = []  # langauge-wise content fields
-        for name in self.ix.schema.names():
-            if re.search(r'^content_', name):
-                content_fields.append(name)
-        search_fields = content_fields + ['title']
+        searcher = self.get_searcher()
+        # generation in key: a result computed by a thread with an old
+        # searcher is never served after refresh
+        cache_key = ('search', searcher.reader().generation(),
+                     ' '.join(normalize(query_str).split()),
+                     sort_field, reverse, n_page, pagelen,
+                     fields, content_length, group_pages, highlight_options)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
 
-        with self.ix.searcher() as searcher:
-            query = MultifieldParser(search_fields,
-                                     self.ix.schema).parse(query_str)
+        with metrics.timer('search_parse'):
+            query = self.parser.parse(query_str)
 
+        if group_pages is not None:
+            res = self.search_grouped(searcher, query, sort_field, reverse,
+                                      n_page, pagelen, fields,
+                                      content_length, group_pages,
+                                      highlight, max_fragments,
+                                      fragment_size)
+            self.cache.put(cache_key, res)
+            return res
+
+        with metrics.timer('search_query'):
             # search onlyt text file
             results = searcher.search_page(query, n_page,
                                            pagelen=pagelen,
@@ -47,60 +214,129 @@ class Search:
             # number of total hit documents
             n_hits = len(results)
 
-            # number of search result pages
-            total_pages = n_hits // pagelen + 1
+        # number of search result pages
+        total_pages = n_hits // pagelen + 1
+
+        if n_page > total_pages:
+            raise ValueError('n_page exceeds total_pages: ' + str(n_page))
+
+        self.set_fragmenter(results.results, fragment_size)
+        highlight_time = 0.
+        res_list = []
+        for r in results:
+            d, t = self._page_row(r, fields, content_length, highlight,
+                                  max_fragments)
+            highlight_time += t
+            res_list.append(d)
+        metrics.observe('search_highlight', highlight_time)
 
-            if n_page > total_pages:
-                raise ValueError('n_page exceeds total_pages: ' + str(n_page))
+        res = {'rows': res_list,
+               'n_hits': n_hits, 'total_pages': total_pages}
+        self.cache.put(cache_key, res)
+        return res
 
-            res_list = []
-            for r in results:
-                d = {}
-                for key in r.keys():  # copy all fields
-                    if type(r[key]) == datetime.datetime:
-                        d[key] = r[key].isoformat()
-                    elif key == 'file_path':
-                        d[key] = self._normalize_path(r[key])
-                    else:
-                        d[key] = r[key]
+    def search_grouped(self, searcher, query, sort_field, reverse=False,
+                       n_page=1, pagelen=10, fields=None,
+                       content_length=None, group_pages=3, highlight=False,
+                       max_fragments=None, fragment_size=None):
+        """Search pages, one row per document with its group_pages best
+        scoring pages. Pages beyond them are collapsed while collecting,
+        and stored fields are loaded only for pages returned.
+        n_hits, pagelen and n_page count documents.
+        """
+        gid_facet = FieldFacet('gid')
+        # text files only; filter= would skip collapsing in whoosh
+        query = And([query, Term('document_format', 'txt')])
+        with metrics.timer('search_query'):
+            results = searcher.search(query, limit=None,
+                                      sortedby=sort_field, reverse=reverse,
+                                      groupedby={'gid': gid_facet},
+                                      collapse=gid_facet,
+                                      collapse_limit=group_pages,
+                                      collapse_order=ScoreFacet())
 
-                content_field_name = 'content_' + r['language']
-                d['content'] = r[content_field_name]
+            gids = {}  # docnum: gid
+            for gid, docnums in results.groups('gid').items():
+                for docnum in docnums:
+                    gids[docnum] = gid
 
-                # remove garbled characters
-                d['highlighted_body'] = self.remove_garble(
-                        r.highlights(content_field_name))
-                res_list.append(d)
+            # documents in order of their first page
+            documents = OrderedDict()  # gid: positions of pages in results
+            for pos in range(results.scored_length()):
+                documents.setdefault(gids[results.docnum(pos)], []).\
+                        append(pos)
 
-            return {'rows': res_list,
-                    'n_hits': n_hits, 'total_pages': total_pages}
+        n_hits = len(documents)
+        total_pages = n_hits // pagelen + 1
+        if n_page > total_pages:
+            raise ValueError('n_page exceeds total_pages: ' + str(n_page))
+
+        self.set_fragmenter(results, fragment_size)
+        highlight_time = 0.
+        res_list = []
+        start = (n_page - 1) * pagelen
+        for gid in list(documents)[start:start + pagelen]:
+            pages = []
+            for pos in documents[gid]:
+                d, t = self._page_row(results[pos], fields, content_length,
+                                      highlight, max_fragments)
+                highlight_time += t
+                pages.append(d)
+            pages.sort(key=lambda d: d.get('page', 0))
+
+            first = searcher.stored_fields(results.docnum(documents[gid][0]))
+            res_list.append({
+                'gid': gid,
+                'title': first.get('title', ''),
+                'parent_file_path': self._normalize_path(
+                    first.get('parent_file_path', '')),
+                'n_page_hits': len(documents[gid]) +
+                               results.collapsed_counts.get(gid, 0),
+                'pages': pages})
+        metrics.observe('search_highlight', highlight_time)
+
+        return {'rows': res_list,
+                'n_hits': n_hits, 'total_pages': total_pages,
+                'n_page_hits': results.scored_length() + sum(
+                    results.collapsed_counts.values())}
+
+    def highlight(self, query_str, file_paths, max_fragments=None,
+                  fragment_size=None):
+        """Highlighted fragments of pages of file_paths matching query_str,
+        e.g. of visible rows only. Return {file path: highlighted body},
+        empty for pages not matching.
+        """
+        searcher = self.get_searcher()
+        query = self.parser.parse(query_str)
+        res = {fp: '' for fp in file_paths}
+        if res == {}:
+            return res
+
+        with metrics.timer('highlight'):
+            results = searcher.search(
+                    query, limit=len(res),
+                    filter=Or([Term('file_path', fp) for fp in res]))
+            self.set_fragmenter(results, fragment_size)
+            for hit in results:
+                stored = hit.fields()
+                if 'language' not in stored:
+                    continue  # pdf, or text of unknown language
+                res[stored['file_path']] = self._highlights(
+                        hit, self.content_store.page_text(stored) or '',
+                        max_fragments)
+        return res
 
     def get_sorted_index(self, field, n_page=1, pagelen=10, reverse=False):
-        with self.ix.searcher() as searcher:
-            query = Every()
-            results = searcher.search_page(query, n_page, pagelen=pagelen,
-                                           sortedby=field, reverse=reverse,
-                                           filter=Term(
-                                               'document_format', 'pdf'))
-            n_docs = len(results)  # number of total documents
-            total_pages = n_docs // pagelen + 1  # number of result pages
-            if n_page > total_pages:
-                raise ValueError
-
-            res_list = []
-            for r in results:
-                d = {}
-                for key in r.keys():  # copy all fields
-                    if type(r[key]) == datetime.datetime:
-                        d[key] = r[key].isoformat()
-                    elif key == 'file_path':
-                        d[key] = self._normalize_path(r[key])
-                    else:
-                        d[key] = r[key]
-                res_list.append(d)
-
-            return {'rows': res_list,
-                    'n_docs': n_docs, 'total_pages': total_pages}
+        searcher = self.get_searcher()
+        with metrics.timer('sorted_index_query'):
+            res_list, n_docs = self.sorted_index.get_page(
+                    searcher, field, n_page, pagelen, reverse)
+        total_pages = n_docs // pagelen + 1  # number of result pages
+        if n_page > total_pages:
+            raise ValueError
+
+        return {'rows': res_list,
+                'n_docs': n_docs, 'total_pages': total_pages}
 
     def remove_garble(self, str):
         """Remove (visually annoying) unicode replacement characters."""
@@ -108,5 +344,5 @@ class Search:
         return str.replace('\uFFFD', '')
 
     def search_print(self, query_str):
-        res = self.search(query_str, sort_field='title')
+        res = self.search(query_str, sort_field='title', highlight=True)
         print(res)
@@ -0,0 +1,107 @@
+from index_manager import SORT_KEY_FIELDS, sort_key
+
+from bisect import bisect_left, insort
+import threading
+
+
+class SortedIndexCache:
+    """Rows of pdf documents in order of sort fields, for paging the
+    sorted index without sorting on every request.
+
+    Rows are read once per index generation, and each field's order is
+    sorted on its first request. Writes through a WriterService update
+    them in place by apply(), instead of reading all rows again.
+    """
+    def __init__(self, to_dict):
+        self.to_dict = to_dict  # stored fields to row
+        self.lock = threading.Lock()
+        self.generation = None
+        self.rows = {}  # gid: row
+        self.column_keys = {}  # field: {gid: key in sort key column}
+        self.orders = {}  # field: sorted list of (key, gid)
+
+    def _row(self, stored):
+        row = self.to_dict(stored)
+        if 'published_at' not in row.keys():
+            row['published_at'] = ''
+        return row
+
+    def _key(self, field, gid):
+        value = self.rows[gid].get(field)
+        if field in SORT_KEY_FIELDS:
+            key = self.column_keys.get(field, {}).get(gid)
+            if key is None:
+                key = sort_key(value or '')
+            return key
+        # documents without the field first
+        return (value is not None and value != '', value or '')
+
+    def build(self, searcher):
+        reader = searcher.reader()
+        columns = {}
+        for field in SORT_KEY_FIELDS:
+            if reader.has_column(field + '_key'):
+                columns[field] = reader.column_reader(field + '_key')
+
+        rows = {}
+        column_keys = {field: {} for field in columns}
+        for docnum in searcher.document_numbers(document_format='pdf'):
+            stored = searcher.stored_fields(docnum)
+            rows[stored['gid']] = self._row(stored)
+            for field, column in columns.items():
+                key = column[docnum]
+                if key:  # empty for documents indexed without the column
+                    column_keys[field][stored['gid']] = key
+
+        self.generation = reader.generation()
+        self.rows = rows
+        self.column_keys = column_keys
+        self.orders = {}
+
+    def get_page(self, searcher, field, n_page=1, pagelen=10, reverse=False):
+        """Rows of n_page, and the number of documents."""
+        with self.lock:
+            generation = searcher.reader().generation()
+            # rows newer than the searcher are also served
+            if self.generation is None or generation > self.generation:
+                self.build(searcher)
+
+            order = self.orders.get(field)
+            if order is None:
+                order = sorted((self._key(field, gid), gid)
+                               for gid in self.rows)
+                self.orders[field] = order
+
+            n_docs = len(order)
+            start = (n_page - 1) * pagelen
+            if reverse:
+                end = n_docs - start
+                items = order[max(0, end - pagelen):max(0, end)][::-1]
+            else:
+                items = order[start:start + pagelen]
+            return [self.rows[gid] for _, gid in items], n_docs
+
+    def apply(self, generation, new_generation, pdf_changes):
+        """Update rows changed by a commit from generation to
+        new_generation. pdf_changes: {gid: stored fields, None if deleted}.
+        Rows of another generation are dropped, and read again when used.
+        """
+        with self.lock:
+            if self.generation != generation:
+                self.generation = None
+                return
+
+            for gid, stored in pdf_changes.items():
+                if gid in self.rows:
+                    for field, order in self.orders.items():
+                        del order[bisect_left(order,
+                                              (self._key(field, gid), gid))]
+                    del self.rows[gid]
+                for keys in self.column_keys.values():
+                    keys.pop(gid, None)
+
+                if stored is not None:
+                    self.rows[gid] = self._row(stored)
+                    for field, order in self.orders.items():
+                        insort(order, (self._key(field, gid), gid))
+            self.generation = new_generation
@@ -1,22 +1,78 @@
 from nose.tools import eq_, ok_
 from whoosh.index import open_dir, exists_in
+from whoosh.fields import TEXT
 from whoosh.query import Every
+import falcon
+import falcon.testing
 
+import functools
+import json
 import unittest
+from unittest import mock
+from urllib.request import urlopen
+from wsgiref.simple_server import WSGIRequestHandler
 import sys
 import os
 import shutil
+import tempfile
+import threading
+import time
 import uuid
 
 sys.path.append(os.path.dirname(__file__) + '/../')
 
+from api_server import CheckProgress, JobResource, ThreadPoolWSGIServer
 from config import Config
-from helper import separate_files
-from index_manager import IndexManager
+from content_store import ContentStore
+from helper import iter_document_groups, separate_files
+from index_manager import IndexManager, changed_analyzers, \
+    detect_group_lang, index_stats, text_hash
+from ingest import add_groups
+from job_manager import JobManager
+from metrics import Metrics
+from result_cache import ResultCache
+from search import add_dir, add_files, add_pdf_files, check_analyzers, \
+    export_index, import_index, open_ndjson, reindex, set_ngram_sizes
 from search_manager import Search
+from writer_service import Compactor, WriterService
+import extractor
 
 test_pdf_name = '../electron/pdfjs/web/compressed.tracemonkey-pldi-09.pdf'
 
+Config.create_dirs()
+
+
+def make_pdf(path, page_texts):
+    """Minimal pdf with one line of text per page."""
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None,
+               b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    kids = []
+    for text in page_texts:
+        stream = 'BT /F1 12 Tf 72 720 Td ({:s}) Tj ET'.format(text).encode()
+        objects.append(b'<< /Length ' + str(len(stream)).encode() +
+                       b' >>\nstream\n' + stream + b'\nendstream')
+        objects.append('<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+                       '/Resources << /Font << /F1 3 0 R >> >> '
+                       '/Contents {:d} 0 R >>'.format(len(objects)).encode())
+        kids.append('{:d} 0 R'.format(len(objects)))
+    objects[1] = '<< /Type /Pages /Kids [{:s}] /Count {:d} >>'.format(
+        ' '.join(kids), len(kids)).encode()
+
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for i, obj in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += str(i).encode() + b' 0 obj\n' + obj + b'\nendobj\n'
+    xref = len(out)
+    out += 'xref\n0 {:d}\n0000000000 65535 f \n'.format(
+        len(objects) + 1).encode()
+    for offset in offsets:
+        out += '{:010d} 00000 n \n'.format(offset).encode()
+    out += 'trailer\n<< /Size {:d} /Root 1 0 R >>\nstartxref\n{:d}\n%%EOF\n'\
+        .format(len(objects) + 1, xref).encode()
+    with open(path, 'wb') as f:
+        f.write(out)
+
 
 class TestSearch(unittest.TestCase):
     def setup(self):
@@ -57,11 +113,560 @@ class TestSearch(unittest.TestCase):
             eq_(len(results), 2)  # expect number of records
         ix.close()
 
+    def test_content_store(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            store = ContentStore(tmp_dir)
+            texts = ['page one', 'page two', 'page one']
+            refs = [store.put('doc', t, text_hash(t)) for t in texts]
+            eq_(refs[0], refs[2])  # stored once
+            # read after appending, and by another store
+            ref = store.put('doc', 'page three', text_hash('page three'))
+            eq_([store.get('doc', r) for r in refs], texts)
+            eq_(ContentStore(tmp_dir).get('doc', ref), 'page three')
+            eq_(ContentStore(tmp_dir).put('doc', 'page two',
+                                          text_hash('page two')), refs[1])
+
+            # compacted, references made before are looked up by hash
+            reader = ContentStore(tmp_dir)
+            eq_(reader.get('doc', ref, text_hash('page three')), 'page three')
+            ok_(store.compact('doc', [text_hash('page three')]) > 0)
+            eq_(store.compact('doc', [text_hash('page three')]), 0)
+            for st in [store, reader, ContentStore(tmp_dir)]:
+                eq_(st.get('doc', ref, text_hash('page three')), 'page three')
+            self.assertRaises(FileNotFoundError, ContentStore(tmp_dir).get,
+                              'doc', refs[0], text_hash('page one'))
+            eq_(os.listdir(tmp_dir), [os.path.basename(store.path('doc'))])
+            store.delete('doc')
+            eq_(os.listdir(tmp_dir), [])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_documents_by_title(self):
+        im = IndexManager()
+        eq_(im.get_documents_by_title('tes'), [])  # shares n-grams
+        docs = im.get_documents_by_title('test')
+        ok_(len(docs) > 0)
+        ok_(all(doc['title'] == 'test' for doc in docs))
+        im.writer.cancel()
+
+    def test_export_import(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'export.ndjson.gz')
+            n_docs = export_index(path)
+            with open_ndjson(path) as f:
+                docs = [json.loads(line) for line in f]
+            eq_(len(docs), n_docs)
+            pages = [doc for doc in docs if doc['document_format'] == 'txt']
+            ok_('abc def' in [doc['content'] for doc in pages])
+
+            # documents are replaced
+            eq_(import_index(path, chunk_size=1), n_docs)
+            eq_(export_index(path), n_docs)
+            search = Search()
+            eq_(search.search('abc', 'title')['rows'][0]['title'], 'test')
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @unittest.skipIf(not extractor.is_available(), 'pdfminer.six needed')
+    def test_extract_pdfs(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            pdf_file = os.path.join(tmp_dir, 'extract.pdf')
+            make_pdf(pdf_file, ['first page', 'second page'])
+            eq_(add_pdf_files([pdf_file], lang='en', write_text=True), 1)
+            eq_(add_pdf_files([pdf_file], lang='en', write_text=True), 0)
+            eq_(add_pdf_files([pdf_file], lang='en'), 0)  # unchanged
+
+            # a modified file replaces its copy, under the same gid
+            copied = os.path.abspath(os.path.join(Config.pdf_dir,
+                                                  'extract.pdf'))
+            im = IndexManager()
+            gid, _ = im.get_pdf_pages(copied)
+            im.writer.cancel()
+            mtime = os.path.getmtime(pdf_file)
+            make_pdf(pdf_file, ['first page', 'edited page'])
+            os.utime(pdf_file, (mtime + 10, mtime + 10))
+            eq_(add_pdf_files([pdf_file], lang='en'), 1)
+            im = IndexManager()
+            eq_(im.get_pdf_pages(copied)[0], gid)
+            im.writer.cancel()
+
+            # pages extracted without text files are kept by add_dir
+            with mock.patch.object(Config, 'pdf_dir',
+                                   os.path.join(tmp_dir, 'pdf')), \
+                    mock.patch.object(Config, 'txt_dir',
+                                      os.path.join(tmp_dir, 'txt')):
+                no_text_file = os.path.join(tmp_dir, 'no_text.pdf')
+                make_pdf(no_text_file, ['first page', 'second page'])
+                eq_(add_pdf_files([no_text_file], lang='en'), 1)
+                add_dir()
+                im = IndexManager()
+                gid, pages = im.get_pdf_pages(
+                        os.path.join(Config.pdf_dir, 'no_text.pdf'))
+                eq_(len(pages), 2)
+                im.delete_document(gid)
+                im.commit()
+
+                # jobs add pages chunk by chunk, in separate mutations
+                job_file = os.path.join(tmp_dir, 'job_extract.pdf')
+                job_copy = os.path.join(Config.pdf_dir, 'job_extract.pdf')
+                iter_page_chunks = functools.partial(
+                        extractor.iter_page_chunks, chunk_size=1)
+                writer = WriterService(batch_interval=0.0)
+                writer.start()
+                jobs = JobManager(writer)
+                gids = []
+                for texts in [['one', 'two', 'three'], ['one', 'two']]:
+                    make_pdf(job_file, texts)
+                    os.utime(job_file, (len(texts), len(texts)))
+                    with mock.patch('extractor.iter_page_chunks',
+                                    iter_page_chunks):
+                        job = jobs.submit([job_file], lang='en', extract=True)
+                        while not job.is_done():
+                            jobs.wait(job.id, job.version, timeout=10.0)
+                    eq_((job.status, job.n_done_groups, job.n_pages),
+                        ('finished', 1, len(texts)))
+                    im = IndexManager()
+                    gid, pages = im.get_pdf_pages(job_copy)
+                    gids.append(gid)
+                    eq_(sorted(im.content_store.page_text(doc)
+                               for doc in pages.values()), sorted(texts))
+                    im.writer.cancel()
+                jobs.stop()
+                eq_(gids[0], gids[1])
+                writer.submit(IndexManager.delete_document, gids[0]).result()
+                writer.stop()
+
+            # a different file of the same name is copied under another name
+            other_file = os.path.join(tmp_dir, 'other', 'extract.pdf')
+            os.makedirs(os.path.dirname(other_file))
+            make_pdf(other_file, ['other page'])
+            eq_(add_pdf_files([other_file], lang='en'), 1)
+            im = IndexManager()
+            other = os.path.abspath(os.path.join(Config.pdf_dir,
+                                                 'extract_2.pdf'))
+            gid, pages = im.get_pdf_pages(other)
+            eq_([im.content_store.page_text(doc) for doc in pages.values()],
+                ['other page'])
+            im.delete_document(gid)
+            im.commit()
+
+            # indexed as a copy in pdf_dir
+            im = IndexManager()
+            eq_(im.get_pdf_pages(pdf_file), (None, {}))
+            gid, pages = im.get_pdf_pages(copied)
+            eq_(sorted((doc['page'], im.content_store.page_text(doc))
+                       for doc in pages.values()),
+                [(1, 'first page'), (2, 'edited page')])
+            im.delete_document(gid)
+            im.commit()
+            ok_(not os.path.exists(copied))
+            ok_(os.path.exists(pdf_file))
+
+            # files are never deleted out of data dirs
+            im = IndexManager()
+            im.add_pdf_file(pdf_file, 'outside')
+            im.writer.commit()
+            im = IndexManager()
+            im.delete_document('outside')
+            im.commit()
+            ok_(os.path.exists(pdf_file))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_group_lang(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            text_files = []
+            for i in range(3):
+                text_file = os.path.join(tmp_dir, 'a_p{:d}.txt'.format(i))
+                with open(text_file, 'w') as f:
+                    f.write('This is a page written in plain English. ' * 20)
+                text_files.append(text_file)
+            eq_(detect_group_lang(text_files), 'en')
+            eq_(detect_group_lang(text_files[:1], sample_size=100), 'en')
+
+        # detected once per document group by add_groups
+        pdf_file = os.path.join(Config.pdf_dir, 'lang.pdf')
+        with open(pdf_file, 'w'):
+            pass
+        text_file = os.path.join(Config.txt_dir, 'lang_p1.txt')
+        with open(text_file, 'w') as f:
+            f.write('Ceci est une page écrite en français. ' * 20)
+        im = IndexManager()
+        group, = separate_files([pdf_file, text_file])
+        with mock.patch('ingest.detect_group_lang',
+                        wraps=detect_group_lang) as detect:
+            add_groups(im, [group])
+        eq_(detect.call_count, 1)
+        eq_(im.langs[group['id']], 'fr')
+        im.writer.cancel()
+        im.ix.close()
+        os.remove(pdf_file)
+        os.remove(text_file)
+
+    def test_incremental_add(self):
+        pdf_file = os.path.join(Config.pdf_dir, 'incremental.pdf')
+        with open(pdf_file, 'w'):
+            pass
+        text_dir = os.path.join(Config.txt_dir, 'incremental')
+        os.makedirs(text_dir, exist_ok=True)
+        text_files = [os.path.join(text_dir, 'incremental_p{:d}.txt'.format(n))
+                      for n in [1, 2]]
+        for tf in text_files:
+            with open(tf, 'w') as f:
+                f.write('xyz')
+        add_files([pdf_file] + text_files)
+        os.remove('progress_add_db')
+
+        im = IndexManager()
+        eq_(im.get_changes(pdf_file, text_files[:1])[2], [])  # on disk
+        os.rename(text_files[1], text_files[1] + '.removed')
+        gid, changed, deleted = im.get_changes(pdf_file, text_files[:1])
+        ok_(gid is not None)
+        eq_(changed, [])
+        eq_(deleted, [text_files[1]])
+        os.rename(text_files[1] + '.removed', text_files[1])
+
+        # same mtime or same content is unchanged, and mtime updated
+        mtime = os.path.getmtime(text_files[0])
+        os.utime(text_files[0], (mtime + 10, mtime + 10))
+        eq_(im.get_changes(pdf_file, text_files)[1], [])
+        im.update_mtimes()
+        im.commit()
+        im = IndexManager()
+        eq_(im.get_documents('file_path', text_files[0])[0]['mtime'],
+            mtime + 10)
+
+        with open(text_files[1], 'w') as f:
+            f.write('xyz uvw')
+        os.utime(text_files[1], (mtime + 10, mtime + 10))
+        eq_(im.get_changes(pdf_file, text_files)[1], [text_files[1]])
+        im.writer.cancel()
+
+        # mtimes are stored after content fields of a new language are
+        # added, in one commit
+        generation = im.ix.latest_generation()
+        os.utime(text_files[0], (mtime + 20, mtime + 20))
+        im = IndexManager()
+        add_groups(im, separate_files([pdf_file] + text_files), lang='fi')
+        im.commit()
+        im = IndexManager()
+        eq_(im.ix.latest_generation(), generation + 1)
+        eq_(im.get_documents('file_path', text_files[0])[0]['mtime'],
+            mtime + 20)
+        eq_(im.get_documents('file_path', text_files[1])[0]['language'],
+            'fi')
+        im.writer.cancel()
+
+    def test_iter_document_groups(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            pdf_dir = os.path.join(tmp_dir, 'pdf')
+            text_dir = os.path.join(tmp_dir, 'txt', 'a')
+            os.makedirs(pdf_dir)
+            os.makedirs(text_dir)
+            for file in ['a.pdf', 'a_b.pdf', 'c.txt']:
+                with open(os.path.join(pdf_dir, file), 'w'):
+                    pass
+            for file in ['a_p2.txt', 'a_p10.txt', 'a_b_p1.txt', 'x.txt']:
+                with open(os.path.join(text_dir, file), 'w'):
+                    pass
+
+            groups = iter_document_groups(pdf_dir, os.path.join(tmp_dir, 'txt'))
+            text_files = {os.path.basename(g['pdf_file']):
+                          [os.path.basename(tf) for tf in g['text_files']]
+                          for g in groups}
+            eq_(text_files, {'a.pdf': ['a_p2.txt', 'a_p10.txt'],
+                             'a_b.pdf': ['a_b_p1.txt']})
+
+    def test_jobs(self):
+        pdf_file = os.path.join(Config.pdf_dir, 'job.pdf')
+        with open(pdf_file, 'w'):
+            pass
+        text_dir = os.path.join(Config.txt_dir, 'job')
+        os.makedirs(text_dir, exist_ok=True)
+        text_files = [os.path.join(text_dir, 'job_p{:d}.txt'.format(n))
+                      for n in [1, 2, 3]]
+        for tf in text_files:
+            with open(tf, 'w') as f:
+                f.write('job page')
+
+        writer = WriterService(batch_interval=0.0)
+        writer.start()
+        jobs = JobManager(writer, batch_size=1)
+        job = jobs.submit([pdf_file] + text_files, lang='en')
+        failed_job = jobs.submit([])
+        while not job.is_done():
+            jobs.wait(job.id, job.version, timeout=10.0)
+        jobs.wait(failed_job.id, 1, timeout=10.0)
+        jobs.stop()
+        writer.stop()
+
+        res = job.to_dict()
+        eq_(res['status'], 'finished')
+        eq_((res['n_groups'], res['n_done_groups'], res['n_pages']), (1, 1, 3))
+        eq_(res['progress'], 1.0)
+        eq_(failed_job.status, 'failed')
+        ok_(jobs.wait('unknown') is None)
+
+        # the last job's end state, not consumed on read
+        progress = CheckProgress(jobs)
+        for _ in range(2):
+            eq_(progress._get_job_state(), 'Failed: Empty document group: []')
+
+        # no long polls without a spare server thread
+        resource = JobResource(jobs, max_polls=0)
+        api = falcon.API()
+        api.add_route('/jobs/{job_id}', resource)
+        start = time.time()
+        res = falcon.testing.TestClient(api).simulate_get(
+            '/jobs/' + job.id, params={'wait': '5', 'since': job.version})
+        ok_(time.time() - start < 1.0)
+        eq_(res.json['status'], 'finished')
+
+    def test_key_lookup(self):
+        # parser syntax in file path
+        text_file = os.path.join(Config.txt_dir, 'a (1) AND b:c [d]_p1.txt')
+        with open(text_file, 'w') as f:
+            f.write('key lookup')
+        im = IndexManager()
+        im.add_text_file(text_file, gid='key-lookup', num_page=1)
+        im.writer.commit()
+
+        im = IndexManager()
+        eq_(len(im.get_documents('file_path', text_file)), 1)
+        im.update_field('file_path', text_file, 'summary', 'looked up')
+        im.writer.commit()
+
+        im = IndexManager()
+        docs = im.get_documents('gid', 'key-lookup')
+        eq_([doc['summary'] for doc in docs], ['looked up'])
+        eq_(im.delete_document('key-lookup', is_keep_file=True),
+            '1 documents deleted.')
+        im.commit()
+
+        # text without gid is stored under a generated one
+        im = IndexManager()
+        im.add_text_file(text_file, num_page=1,
+                         prepared=('key lookup', 'en'))
+        im.commit()
+        im = IndexManager()
+        doc = im.get_documents('file_path', text_file)[0]
+        eq_(im.content_store.page_text(doc), 'key lookup')
+        im.delete_document(doc['gid'], is_keep_file=True)
+        eq_(im.content_store.page_text(doc), 'key lookup')  # until commit
+        im.commit()
+        eq_(im.content_store.page_text(doc), None)
+
+    def test_lang_fields(self):
+        im = IndexManager()
+        generation = im.ix.latest_generation()
+        im.add_lang_fields(['fr', 'ko', None])
+        eq_(im.ix.latest_generation(), generation)  # not committed yet
+        im.writer.commit()
+        names = im.ix.schema.names()
+        ok_('content_fr' in names)
+        ok_('content_ko' in names)
+        im.ix.close()
+
+    def test_metrics(self):
+        m = Metrics()
+        m.count('pages', 3)
+        m.count('pages', 2)
+        with m.timer('request', resource='SearchDB'):
+            pass
+        res = m.to_dict()
+        eq_(res['counters']['pages']['total'], 5)
+        eq_(res['timings']['request{resource="SearchDB"}']['count'], 1)
+        ok_('mirusan_request_seconds_count{resource="SearchDB"} 1'
+            in m.to_prometheus())
+
+    def test_optimize(self):
+        text_file = os.path.join(Config.txt_dir, 'optimize_p1.txt')
+        with open(text_file, 'w') as f:
+            f.write('optimize')
+        im = IndexManager()
+        im.add_text_file(text_file, gid='optimize')
+        im.writer.commit(merge=False)  # new segment
+        ok_(index_stats(im.ix)['segments'] > 1)
+        im.ix.close()
+
+        writer = WriterService(batch_interval=0.0)
+        writer.start()
+        compactor = Compactor(writer, max_segments=1)
+        future = compactor.check()
+        ok_(future is not None)
+        stats = future.result()
+        eq_(stats['segments'], 1)
+        eq_(stats['deleted_documents'], 0)
+        ok_(compactor.check() is None)  # already compact
+        writer.stop()
+
+        # texts of changed pages are removed from the ContentStore
+        for text in ['optimize again', 'optimize once more']:
+            with open(text_file, 'w') as f:
+                f.write(text)
+            im = IndexManager()
+            im.add_text_file(text_file, gid='optimize')
+            im.commit()
+        path = im.content_store.path('optimize')
+        size = os.path.getsize(path)
+        im = IndexManager()
+        im.optimize()
+        ok_(os.path.getsize(path) < size)
+        doc, = im.get_documents('file_path', text_file)
+        eq_(ContentStore().page_text(doc), 'optimize once more')
+        im.writer.cancel()
+        im.ix.close()
+
+    def test_reindex(self):
+        eq_(check_analyzers(), [])
+        n_docs = index_stats(open_dir(Config.database_dir))['documents']
+        profiles = Config.get().get('analyzers')
+        try:
+            Config.get()['analyzers'] = {
+                    'metadata': {'analyzer': 'ngram', 'ngram_min': 2,
+                                 'ngram_max': 2},
+                    'en': {'analyzer': 'standard', 'stopwords': False}}
+            ok_({'title', 'summary', 'content_en'} <= set(check_analyzers()))
+            ix = open_dir(Config.database_dir)
+            eq_(changed_analyzers(ix.schema), [])
+            # content stored in the index, before the ContentStore
+            schema = ix.schema.copy()
+            schema.remove('content_en')
+            schema.add('content_en', TEXT(
+                stored=True, analyzer=schema['title'].analyzer))
+            eq_(changed_analyzers(schema), ['content_en'])
+            eq_(index_stats(ix)['documents'], n_docs)
+            ix.close()
+        finally:
+            Config.get()['analyzers'] = profiles
+        ok_('title' in check_analyzers())
+        search = Search()
+        eq_(search.search('abc', 'title')['rows'][0]['title'], 'test')
+
+        # a failed reindex keeps the index
+        with mock.patch.object(IndexManager, 'import_documents',
+                               side_effect=ValueError('failed')):
+            self.assertRaises(ValueError, reindex)
+        eq_(index_stats(open_dir(Config.database_dir))['documents'], n_docs)
+        eq_(reindex(), n_docs)
+        ok_(not os.path.exists(Config.database_dir + '.new'))
+
+        # n-gram sizes are saved to config.json
+        config_file_path = Config.get()['config_file_path']
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            Config.get()['config_file_path'] = \
+                os.path.join(tmp_dir, 'config.json')
+            try:
+                set_ngram_sizes(ngram_max=3)
+                with open(Config.get()['config_file_path']) as f:
+                    saved = json.load(f)
+            finally:
+                Config.get()['config_file_path'] = config_file_path
+                Config.get()['analyzers'] = profiles
+        eq_(saved['analyzers']['default']['ngram_max'], 3)
+        ok_('config_file_path' not in saved)
+
+    def test_parallel_add(self):
+        texts = {'en': 'This is a page written in plain English. ' * 20,
+                 'de': 'Dies ist eine Seite in einfachem Deutsch. ' * 20}
+        files = []
+        for lang, text in texts.items():
+            name = 'parallel_' + lang
+            pdf_file = os.path.join(Config.pdf_dir, name + '.pdf')
+            with open(pdf_file, 'w'):
+                pass
+            text_dir = os.path.join(Config.txt_dir, name)
+            os.makedirs(text_dir, exist_ok=True)
+            files.append(pdf_file)
+            for n in [1, 2]:
+                text_file = os.path.join(text_dir,
+                                         '{:s}_p{:d}.txt'.format(name, n))
+                with open(text_file, 'w') as f:
+                    f.write(text)
+                files.append(text_file)
+        add_files(files, procs=2)
+        os.remove('progress_add_db')
+
+        im = IndexManager()
+        ok_({'content_en', 'content_de'} <= set(im.writer.schema.names()))
+        for lang in texts:
+            docs = im.get_documents_by_title('parallel_' + lang)
+            eq_(sorted((doc['document_format'], doc.get('language'))
+                       for doc in docs),
+                [('pdf', None), ('txt', lang), ('txt', lang)])
+            pages = [doc for doc in docs if doc['document_format'] == 'txt']
+            eq_(im.content_store.page_text(pages[0]), texts[lang])
+            im.delete_document(docs[0]['gid'])
+        im.commit()
+
+    def test_result_cache(self):
+        cache = ResultCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        eq_(cache.get('a'), 1)
+        cache.put('c', 3)  # evict least recently used
+        eq_(cache.get('b'), None)
+        eq_(cache.stats()['hits'], 1)
+        eq_(cache.stats()['misses'], 1)
+
     def test_search(self):
         search = Search()
         qstr = 'abc'
         res = search.search(query_str=qstr, sort_field='title')
         eq_(res['rows'][0]['title'], 'test')
+        ok_('content_hash' not in res['rows'][0])
+
+        # not a content field
+        content_hash = text_hash('abc def')
+        eq_(search.search(content_hash, 'title')['rows'], [])
+
+    def test_search_highlight(self):
+        search = Search()
+        res = search.search(query_str='abc', sort_field='title')
+        ok_('highlighted_body' not in res['rows'][0])
+        res = search.search(query_str='abc', sort_field='title',
+                            highlight=True)
+        highlighted = res['rows'][0]['highlighted_body']
+        ok_('class="match' in highlighted)
+
+        file_path = res['rows'][0]['file_path']
+        res = search.highlight('abc', [file_path, 'missing'])
+        eq_(res, {file_path: highlighted, 'missing': ''})
+
+    def test_search_grouped(self):
+        search = Search()
+        res = search.search(query_str='job', sort_field='title',
+                            fields=['title', 'page'], group_pages=2)
+        eq_(res['n_hits'], 1)
+        eq_(res['n_page_hits'], 3)
+        row = res['rows'][0]
+        eq_(row['title'], 'job')
+        eq_(row['n_page_hits'], 3)
+        eq_(len(row['pages']), 2)  # others collapsed
+
+    def test_search_fields(self):
+        search = Search()
+        res = search.search(query_str='abc', sort_field='title',
+                            fields=['title', 'page', 'content'],
+                            content_length=3)
+        eq_(res['rows'][0], {'title': 'test', 'page': 1, 'content': 'abc'})
+
+    def test_searcher_refresh(self):
+        search = Search()
+        searcher = search.get_searcher()
+        ok_(search.get_searcher() is searcher)  # cached while index unchanged
+        search.cache.put('key', 'value')
+
+        im = IndexManager()
+        im.add_lang_fields(['it'])
+        im.writer.commit()
+        ok_(search.get_searcher() is not searcher)
+        ok_('content_it' in search.search_fields)
+        eq_(search.cache.get('key'), None)
+        search.close()
 
     def test_separate_files(self):
         files = ['test.pdf', 'test_p1.txt', 'test_p2.txt']
@@ -70,6 +675,13 @@ class TestSearch(unittest.TestCase):
         eq_(groups[0]['pdf_file'], 'test.pdf')
         eq_(len(groups[0]['text_files']), 2)
 
+    def test_separate_files_exact_title(self):
+        files = ['a.pdf', 'a (1)+.pdf', 'a_p1.txt', 'ab_p1.txt',
+                 'a (1)+_p1.txt', 'a (1)+_p2.txt']
+        groups = separate_files(files)
+        eq_(groups[0]['text_files'], ['a_p1.txt'])
+        eq_(groups[1]['text_files'], ['a (1)+_p1.txt', 'a (1)+_p2.txt'])
+
     def test_delete_document(self):
         im = IndexManager()
         with im.ix.searcher() as searcher:
@@ -78,6 +690,171 @@ class TestSearch(unittest.TestCase):
             gid = r['gid']
             im.delete_document(gid)
 
+    def test_sorted_index(self):
+        search = Search()
+        res = search.get_sorted_index('title')
+        eq_([row['title'] for row in res['rows']],
+            ['compressed.tracemonkey-pldi-09', 'incremental', 'job'])
+        eq_(res['n_docs'], 3)
+        res = search.get_sorted_index('title', n_page=2, pagelen=2,
+                                      reverse=True)
+        eq_([row['title'] for row in res['rows']],
+            ['compressed.tracemonkey-pldi-09'])
+        job_pdf = search.get_sorted_index('title')['rows'][2]['file_path']
+
+        # updated in place on writes
+        writer = WriterService(batch_interval=0.0)
+        writer.listeners.append(search.sorted_index.apply)
+        writer.start()
+        for title in ['A job', 'job']:
+            generation = search.sorted_index.generation
+            writer.submit(IndexManager.update_field, 'file_path', job_pdf,
+                          'title', title).result()
+            ok_(search.sorted_index.generation > generation)
+            res = search.get_sorted_index('title', pagelen=1)
+            eq_(res['rows'][0]['title'],
+                'A job' if title == 'A job' else
+                'compressed.tracemonkey-pldi-09')
+        writer.stop()
+
+    def test_thread_pool_server(self):
+        started = threading.Event()
+        released = threading.Event()
+
+        def app(environ, start_response):
+            if environ['PATH_INFO'] == '/slow':
+                started.set()
+                released.wait(5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'ok']
+
+        httpd = ThreadPoolWSGIServer(('127.0.0.1', 0), WSGIRequestHandler, 2)
+        httpd.set_app(app)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        url = 'http://127.0.0.1:{:d}'.format(httpd.server_port)
+        try:
+            slow = threading.Thread(target=lambda: urlopen(url + '/slow',
+                                                           timeout=5).read())
+            slow.start()
+            ok_(started.wait(5))
+            # served while /slow is in progress
+            with urlopen(url + '/fast', timeout=5) as res:
+                eq_(res.read(), b'ok')
+            released.set()
+            slow.join()
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_update_documents(self):
+        im = IndexManager()
+        gid = im.get_documents_by_title('job')[0]['gid']  # by test_jobs
+        keys = im.get_keys('file_path', 'gid', gid)
+        eq_(len(keys), 4)  # pdf and 3 pages
+        eq_(im.get_keys('gid', 'title', 'jo'), [])  # shares n-grams
+        eq_(im.get_keys('gid', 'title', 'job'), [gid])
+        generation = im.ix.latest_generation()
+        results = im.update_documents('file_path', keys + ['missing'],
+                                      summary='bulk')
+        eq_([r['status'] for r in results], ['updated'] * 4 + ['error'])
+        im.writer.commit()
+
+        im = IndexManager()
+        eq_(im.ix.latest_generation(), generation + 1)  # one commit
+        eq_({doc['summary'] for doc in im.get_documents('gid', gid)},
+            {'bulk'})
+        results = im.delete_documents([gid, gid, 'missing'],
+                                      is_keep_file=True)
+        eq_([r['status'] for r in results], ['deleted', 'not found'])
+        im.commit()
+
+        im = IndexManager()
+        eq_(im.get_documents('gid', gid), [])
+        im.writer.cancel()
+
+    def test_writer_service(self):
+        generation = open_dir(Config.database_dir).latest_generation()
+        writer = WriterService(batch_size=2, batch_interval=10.0)
+        writer.start()
+        futures = [writer.submit(IndexManager.add_lang_fields, [lang])
+                   for lang in ['nl', 'sv']]
+        eq_([f.result() for f in futures], [['nl'], ['sv']])
+        writer.stop()
+
+        # two mutations in one commit
+        ix = open_dir(Config.database_dir)
+        eq_(ix.latest_generation(), generation + 1)
+        ix.close()
+
+        # mutations of a document changed earlier in the batch
+        pdf_file = os.path.join(Config.pdf_dir, 'batch.pdf')
+        for order in ['delete first', 'update first']:
+            im = IndexManager()
+            im.add_pdf_file(pdf_file, 'batch')
+            im.writer.commit()
+
+            writer = WriterService(batch_size=2, batch_interval=10.0)
+            writer.start()
+            delete = (IndexManager.delete_document, 'batch', True)
+            update = (IndexManager.update_field, 'file_path', pdf_file,
+                      'title', 'updated')
+            mutations = [delete, update]
+            if order == 'update first':
+                mutations.reverse()
+            futures = [writer.submit(*m) for m in mutations]
+            writer.stop()
+
+            if order == 'delete first':
+                eq_(futures[0].result(), '1 documents deleted.')
+                ok_(isinstance(futures[1].exception(), ValueError))
+            else:
+                eq_(futures[0].result(), None)
+                eq_(futures[1].result(), '1 documents deleted.')
+            im = IndexManager()
+            eq_(im.get_documents('gid', 'batch'), [])
+            im.writer.cancel()
+
+        # mutations of a page added again earlier in the batch
+        pdf_file = os.path.join(Config.pdf_dir, 'readd.pdf')
+        with open(pdf_file, 'w'):
+            pass
+        text_file = os.path.join(Config.txt_dir, 'readd_p1.txt')
+        with open(text_file, 'w') as f:
+            f.write('old text')
+        add_files([pdf_file, text_file], lang='en')
+        os.remove('progress_add_db')
+        im = IndexManager()
+        gid, _ = im.get_pdf_pages(pdf_file)
+        im.writer.cancel()
+        for text in ['new text', 'newer text']:
+            with open(text_file, 'w') as f:
+                f.write(text)
+            writer = WriterService(batch_size=2, batch_interval=10.0)
+            writer.start()
+            writer.submit(add_groups, separate_files([pdf_file, text_file]),
+                          lang='en')
+            if text == 'new text':
+                future = writer.submit(IndexManager.update_field,
+                                       'file_path', text_file, 'title',
+                                       'updated')
+            else:
+                future = writer.submit(IndexManager.delete_document, gid,
+                                       True)
+            writer.stop()
+
+            im = IndexManager()
+            if text == 'new text':
+                eq_(future.result(), None)
+                doc, = im.get_documents('file_path', text_file)
+                eq_((doc['title'], doc['content_hash']),
+                    ('updated', text_hash(text)))
+                eq_(im.content_store.page_text(doc), text)
+            else:
+                eq_(future.result(), '2 documents deleted.')
+                eq_(im.get_documents('gid', gid), [])
+                ok_(not os.path.exists(im.content_store.path(gid)))
+            im.writer.cancel()
+
 
 def teardown(self):
     print('Delete test data dir')
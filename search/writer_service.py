@@ -0,0 +1,169 @@
+from config import Config
+from index_manager import IndexManager, index_stats
+
+from whoosh.index import open_dir
+
+from concurrent.futures import Future
+import queue
+import threading
+import time
+
+
+class WriterService:
+    """Apply index mutations from a single background thread.
+
+    A mutation is a function taking an IndexManager as its first argument,
+    e.g. IndexManager.delete_document. Queued mutations are applied in
+    order through one writer, and committed together when batch_size
+    mutations are collected or batch_interval seconds have passed since
+    the first one. submit() returns a Future, resolved after the commit.
+
+    listeners are called after each commit with the index generations
+    before and after it, and the pdf documents changed by it, see
+    IndexManager.pdf_changes.
+    """
+    def __init__(self, batch_size=100, batch_interval=0.5, lock_timeout=60.0):
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.lock_timeout = lock_timeout  # wait for e.g. --add-files process
+        self.queue = queue.Queue()
+        self.listeners = []
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def submit(self, mutation, *args, **kwargs):
+        future = Future()
+        self.queue.put((future, mutation, args, kwargs))
+        return future
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            batch = [item]
+            deadline = time.time() + self.batch_interval
+            is_stopped = False
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    is_stopped = True
+                    break
+                batch.append(item)
+
+            self.apply(batch)
+            if is_stopped:
+                return
+
+    def apply(self, batch):
+        try:
+            im = IndexManager(timeout=self.lock_timeout)
+        except Exception as err:
+            Config.logger.exception('Could not open writer: %s', err)
+            for future, _, _, _ in batch:
+                future.set_exception(err)
+            return
+
+        generation = im.ix.latest_generation()
+        results = []
+        for future, mutation, args, kwargs in batch:
+            try:
+                results.append((future, mutation(im, *args, **kwargs), None))
+            except Exception as err:
+                Config.logger.exception('Error in mutation: %s', err)
+                results.append((future, None, err))
+
+        try:
+            im.commit()
+        except Exception as err:
+            Config.logger.exception('Could not commit: %s', err)
+            for future, _, _, _ in batch:
+                future.set_exception(err)
+            return
+        finally:
+            im.ix.close()
+
+        Config.logger.debug('Committed {:d} mutations'.format(len(batch)))
+        new_generation = im.ix.latest_generation()
+        for listener in self.listeners:
+            try:
+                listener(generation, new_generation, im.pdf_changes)
+            except Exception as err:
+                Config.logger.exception('Error in listener: %s', err)
+        for future, result, err in results:
+            if err is None:
+                future.set_result(result)
+            else:
+                future.set_exception(err)
+
+
+class Compactor:
+    """Optimize the index in the background through a WriterService.
+
+    The index is checked every interval seconds, and optimized when it has
+    more than max_segments segments, or a ratio of deleted documents above
+    max_deleted_ratio. 0 disables a threshold.
+    """
+    def __init__(self, writer, interval=600.0, max_segments=20,
+                 max_deleted_ratio=0.2):
+        self.writer = writer
+        self.interval = interval
+        self.max_segments = max_segments
+        self.max_deleted_ratio = max_deleted_ratio
+        self.future = None  # pending optimization
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def needs_compaction(self, stats):
+        if self.max_segments > 0 and stats['segments'] > self.max_segments:
+            return True
+        if self.max_deleted_ratio > 0 and \
+                stats['deleted_ratio'] > self.max_deleted_ratio:
+            return True
+        return False
+
+    def check(self):
+        """Submit optimization if needed and not pending. Return its
+        Future, or None if not submitted.
+        """
+        if self.future is not None and not self.future.done():
+            return None
+
+        ix = open_dir(Config.database_dir)
+        try:
+            stats = index_stats(ix)
+        finally:
+            ix.close()
+        if not self.needs_compaction(stats):
+            return None
+
+        Config.logger.info('Compact index: ' + str(stats))
+        self.future = self.writer.submit(IndexManager.optimize)
+        return self.future
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as err:
+                Config.logger.exception('Error in compaction: %s', err)